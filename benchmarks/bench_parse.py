@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2013 Jeff Gentes
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+#Parsing microbenchmarks for geni.py over the synthetic corpus written by
+#make_corpus.py (generated responses, not recorded Geni traffic).
+#
+#Runs offline. For every parser and corpus file it reports throughput
+#(parses per second), retained memory per parsed object and the number of
+#container objects each parse leaves allocated. Results are written as
+#JSON so two commits can be compared:
+#
+#    python benchmarks/bench_parse.py --output before.json
+#    python benchmarks/bench_parse.py --compare before.json
+
+import gc
+import json
+import optparse
+import os
+import sys
+import time
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BASE))
+
+import geni
+
+CORPUS = os.path.join(BASE, "corpus")
+
+
+def load(name):
+    with open(os.path.join(CORPUS, name + ".json")) as f:
+        return json.load(f)
+
+
+def deep_size(obj, seen=None):
+    """Approximate bytes held by obj and everything it references."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    else:
+        if hasattr(obj, "__dict__"):
+            size += deep_size(obj.__dict__, seen)
+        for klass in type(obj).__mro__:
+            for slot in getattr(klass, "__slots__", ()):
+                if hasattr(obj, slot):
+                    size += deep_size(getattr(obj, slot), seen)
+    return size
+
+
+def family(name):
+    response = load(name)
+    return lambda: geni.Family("profile", response)
+
+
+def group(name):
+    response = load(name)
+    api = geni.GeniAPI()
+    return lambda: api.process_group(response)
+
+
+def union_edges(name):
+    response = load(name)
+    focus = response["focus"]["id"]
+    unions = []
+    for item in response["nodes"]:
+        if item.startswith("union"):
+            unions.append(geni.Union(item, response["nodes"][item]))
+    edges = []
+    for union in unions:
+        for profile, edge in response["nodes"][union.get_id()]["edges"].items():
+            edges.append((union, profile, edge["rel"]))
+    def run():
+        return [union.get_edge(profile, focus, rel, "male", None) for union, profile, rel in edges]
+    return run
+
+
+def project(name):
+    response = dict(load(name))
+    # Parse a single page; paging would need the network.
+    response.pop("next_page", None)
+    return lambda: geni.Project("project-1", response).get_results()
+
+
+BENCHMARKS = [
+    ("Family", "family_small", family),
+    ("Family", "family_large", family),
+    ("Family", "family_many_unions", family),
+    ("GeniAPI.process_group", "group_10", group),
+    ("Union.get_edge", "family_many_unions", union_edges),
+    ("Project.process_response", "project_page", project),
+    ]
+
+
+def measure(run, min_time):
+    run()
+    loops = 0
+    gc.disable()
+    try:
+        start = time.time()
+        elapsed = 0.0
+        while elapsed < min_time:
+            for i in range(10):
+                run()
+            loops += 10
+            elapsed = time.time() - start
+    finally:
+        gc.enable()
+    gc.collect()
+    before = len(gc.get_objects())
+    kept = [run() for i in range(10)]
+    gc.collect()
+    allocations = (len(gc.get_objects()) - before) / 10.0
+    return {
+        "parses_per_sec": loops / elapsed,
+        "usec_per_parse": elapsed / loops * 1e6,
+        "bytes_per_object": deep_size(kept[0]),
+        "allocations_per_parse": allocations,
+        }
+
+
+def compare(results, baseline):
+    old = {}
+    for item in baseline["results"]:
+        old[(item["parser"], item["corpus"])] = item
+    for item in results:
+        before = old.get((item["parser"], item["corpus"]))
+        if not before:
+            continue
+        print "%-26s %-20s speed x%.2f  memory x%.2f  allocations x%.2f" % (
+            item["parser"], item["corpus"],
+            item["parses_per_sec"] / before["parses_per_sec"],
+            float(item["bytes_per_object"]) / (before["bytes_per_object"] or 1),
+            item["allocations_per_parse"] / (before["allocations_per_parse"] or 1))
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--min-time", type="float", default=1.0,
+                      help="seconds to run each benchmark")
+    parser.add_option("--output", help="write the JSON results to this file")
+    parser.add_option("--compare", help="JSON results of an earlier run to compare against")
+    opts, args = parser.parse_args()
+    results = []
+    for name, corpus, setup in BENCHMARKS:
+        result = measure(setup(corpus), opts.min_time)
+        result.update({"parser": name, "corpus": corpus})
+        results.append(result)
+    report = {"python": sys.version.split()[0], "time": int(time.time()), "results": results}
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(results, json.load(f))
+    else:
+        print json.dumps(report, indent=1, sort_keys=True, separators=(",", ": "))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2013 Jeff Gentes
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+#Writes the synthetic response corpus used by bench_parse.py.
+#
+#The responses are generated, not recorded from Geni: they have the shape
+#of Geni's profile/immediate-family and project-N/profiles replies, but
+#every id, name and family layout is made up, so sizes and field mixes
+#only approximate real traffic. The output
+#is deterministic, so rerunning this only changes the corpus when the
+#generator changes.
+
+import json
+import os
+import random
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+
+class FamilyBuilder(object):
+    def __init__(self, rand, focus):
+        self.rand = rand
+        self.next_id = focus
+        self.nodes = {}
+        self.unions = 0
+        self.focus = self.profile()
+
+    def profile(self, gender=None):
+        id = "profile-%d" % self.next_id
+        self.next_id += 1
+        node = {"id": id, "name": "Person %d" % self.next_id, "public": True, "edges": {}}
+        gender = gender or self.rand.choice(["male", "female", "male", "female", None])
+        if gender:
+            node["gender"] = gender
+        if self.rand.random() < 0.15:
+            node["master_profile"] = id
+        self.nodes[id] = node
+        return id
+
+    def union(self, partners, children, status="spouse"):
+        self.unions += 1
+        id = "union-%d" % (self.next_id * 10 + self.unions)
+        union = {"edges": {}}
+        if status:
+            union["status"] = status
+        for profile in partners:
+            union["edges"][profile] = {"rel": "partner"}
+            self.nodes[profile]["edges"][id] = {"rel": "partner"}
+        for profile in children:
+            union["edges"][profile] = {"rel": "child"}
+            self.nodes[profile]["edges"][id] = {"rel": "child"}
+        self.nodes[id] = union
+        return id
+
+    def response(self):
+        return {"focus": {"id": self.focus, "name": self.nodes[self.focus]["name"]},
+                "nodes": self.nodes}
+
+
+def family(rand, focus, parent_unions=1, spouse_unions=1, siblings=3, children=3):
+    builder = FamilyBuilder(rand, focus)
+    for i in range(parent_unions):
+        parents = [builder.profile("male"), builder.profile("female")]
+        kids = [builder.focus] if i == 0 else []
+        kids += [builder.profile() for j in range(siblings)]
+        builder.union(parents, kids, rand.choice(["spouse", "spouse", "ex_spouse", None]))
+    for i in range(spouse_unions):
+        partner = builder.profile()
+        kids = [builder.profile() for j in range(children)]
+        builder.union([builder.focus, partner], kids, rand.choice(["spouse", "ex_spouse"]))
+    return builder.response()
+
+
+def project_page(rand, page, size, pages):
+    results = []
+    for i in range(size):
+        item = {"id": "profile-%d" % (1000000 + page * size + i)}
+        if rand.random() < 0.9:
+            item["name"] = "Member %d" % (page * size + i)
+        results.append(item)
+    response = {"results": results, "page": page, "total_count": size * pages}
+    if page < pages:
+        response["next_page"] = "https://www.geni.com/api/project-1/profiles?fields=id%2Cname&page=" + str(page + 1)
+    return response
+
+
+def main():
+    rand = random.Random(1999)
+    corpus = {
+        "family_small": family(rand, 100, 1, 1, 1, 1),
+        "family_large": family(rand, 200, 2, 3, 8, 6),
+        "family_many_unions": family(rand, 400, 12, 25, 4, 5),
+        "group_10": {"results": [family(rand, 1000 + i * 100, 1, rand.randint(0, 2),
+                                        rand.randint(0, 6), rand.randint(0, 5))
+                                 for i in range(10)]},
+        "project_page": project_page(rand, 1, 50, 4),
+        }
+    if not os.path.isdir(CORPUS):
+        os.makedirs(CORPUS)
+    for name in sorted(corpus):
+        with open(os.path.join(CORPUS, name + ".json"), "w") as f:
+            json.dump(corpus[name], f, indent=1, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+        print "Wrote " + name + ".json"
+
+if __name__ == "__main__":
+    main()
@@ -16,11 +16,23 @@
 
 #Python client library for the Geni Platform.
 
+import functools
+import httplib
 import urllib
 import urllib2
+import urlparse
 import logging
+import socket
+import sqlite3
+import threading
 import time
 
+from collections import OrderedDict
+from StringIO import StringIO
+
+import metrics
+from relation import relation_label
+
 # Find a JSON parser
 try:
     import simplejson as json
@@ -31,6 +43,32 @@ except ImportError:
         import json
 _parse_json = json.loads
 
+# Tornado is only needed by AsyncGeniAPI
+try:
+    import tornado.httpclient
+    import tornado.ioloop
+except ImportError:
+    tornado = None
+
+_request_count = metrics.registry.counter(
+    "geni_requests_total", "Geni API calls sent, retries included.")
+_request_errors = metrics.registry.counter(
+    "geni_request_errors_total", "Geni API calls that failed, by reason.", ("reason",))
+# Error messages counted under their own reason; the rest count as "other"
+# so the label stays bounded whatever text Geni sends back.
+_error_reasons = {
+    "Access Denied": "access_denied",
+    "Invalid access token": "invalid_token",
+    "Rate limit exceeded.": "rate_limited",
+    "connection": "connection",
+    }
+_rate_limited = metrics.registry.counter(
+    "geni_rate_limited_total", "Geni API calls answered with \"Rate limit exceeded.\".")
+_response_bytes = metrics.registry.counter(
+    "geni_response_bytes_total", "Bytes of Geni API responses read.")
+_request_seconds = metrics.registry.histogram(
+    "geni_request_seconds", "Latency of Geni API calls.")
+
 # Find a query string parser
 try:
     from urlparse import parse_qs
@@ -38,7 +76,422 @@ except ImportError:
     from cgi import parse_qs
 
 
+class ConnectionPool(object):
+    """Keep-alive HTTP(S) connections shared by every GeniAPI instance.
+
+    At most maxsize connections per (scheme, host) are open at once;
+    further requests wait for one to be released. Idle connections are
+    kept for reuse. urlopen mimics urllib2.urlopen so callers can treat
+    the result the same way.
+    """
+    def __init__(self, maxsize=8, timeout=60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.pools = {}
+        self.slots = {}
+        self.active = 0
+        self.waits = 0
+        self.hits = 0
+        self.misses = 0
+        self.discards = 0
+        self.retries = 0
+
+    def _acquire(self, key):
+        with self.lock:
+            slots = self.slots.get(key)
+            if slots is None:
+                slots = self.slots[key] = threading.BoundedSemaphore(self.maxsize)
+        if not slots.acquire(False):
+            with self.lock:
+                self.waits += 1
+            slots.acquire()
+        with self.lock:
+            self.active += 1
+        return slots
+
+    def _release(self, slots):
+        with self.lock:
+            self.active -= 1
+        slots.release()
+
+    def _get_conn(self, key):
+        with self.lock:
+            idle = self.pools.get(key)
+            if idle:
+                self.hits += 1
+                return idle.pop(), True
+            self.misses += 1
+        return self._new_conn(key), False
+
+    def _new_conn(self, key):
+        scheme, host = key
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _put_conn(self, key, conn):
+        with self.lock:
+            idle = self.pools.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+            self.discards += 1
+        conn.close()
+
+    def urlopen(self, url, data=None, redirects=5):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        method = "GET"
+        headers = {"Connection": "keep-alive"}
+        if data is not None:
+            method = "POST"
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        slots = self._acquire(key)
+        try:
+            conn, reused = self._get_conn(key)
+            try:
+                conn.request(method, path, data, headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # The server dropped an idle keep-alive connection; retry
+                # once on a fresh one.
+                with self.lock:
+                    self.retries += 1
+                conn = self._new_conn(key)
+                try:
+                    conn.request(method, path, data, headers)
+                    response = conn.getresponse()
+                    body = response.read()
+                except:
+                    conn.close()
+                    raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._put_conn(key, conn)
+        finally:
+            self._release(slots)
+        status = response.status
+        if status in (301, 302, 303, 307) and redirects > 0:
+            location = response.getheader("location")
+            if location:
+                location = urlparse.urljoin(url, location)
+                return self.urlopen(location, None if status == 303 else data, redirects - 1)
+        if status >= 400:
+            raise urllib2.HTTPError(url, status, response.reason, response.msg, StringIO(body))
+        return PooledResponse(url, status, response.msg, body)
+
+    def stats(self):
+        with self.lock:
+            idle = 0
+            for item in self.pools.values():
+                idle += len(item)
+            return {"hits": self.hits, "misses": self.misses, "discards": self.discards,
+                    "retries": self.retries, "idle": idle, "active": self.active, "waits": self.waits}
+
+
+class PooledResponse(object):
+    """File-like response returned by ConnectionPool.urlopen."""
+    def __init__(self, url, code, headers, body):
+        self.url = url
+        self.code = code
+        self.headers = headers
+        self.length = len(body)
+        self.fp = StringIO(body)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def close(self):
+        self.fp.close()
+
+
+class RateLimiter(object):
+    """Token bucket that every Geni call in the process passes through.
+
+    Callers reserve a token in arrival order and are told how long to wait
+    for it, so waiting threads are served first come, first served. The
+    rate follows the X-API-Rate-* headers Geni sends back.
+    """
+    def __init__(self, rate=10.0, burst=10):
+        self.lock = threading.Lock()
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.throttled = 0
+        self.waited = 0.0
+        self.limited = 0
+
+    def reserve(self):
+        """Takes a token and returns the seconds to wait before using it."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            wait = -self.tokens / self.rate
+            self.throttled += 1
+            self.waited += wait
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, headers):
+        """Adjusts the bucket from Geni's rate limit response headers."""
+        if not headers:
+            return
+        try:
+            limit = headers.get("X-API-Rate-Limit")
+            window = headers.get("X-API-Rate-Window")
+            remaining = headers.get("X-API-Rate-Remaining")
+            limit = int(limit) if limit else None
+            window = float(window) if window else None
+            remaining = int(remaining) if remaining else None
+        except (TypeError, ValueError):
+            return
+        with self.lock:
+            if limit and window:
+                self.rate = limit / window
+                self.burst = limit
+            if remaining is not None:
+                self.tokens = min(self.tokens, remaining)
+
+    def backoff(self):
+        """Called after "Rate limit exceeded."; empties the bucket so every
+        caller pauses for one full refill instead of retrying at once."""
+        with self.lock:
+            self.limited += 1
+            self.tokens = min(self.tokens, -float(self.burst))
+
+    def stats(self):
+        with self.lock:
+            return {"rate": self.rate, "burst": self.burst, "throttled": self.throttled,
+                    "waited": self.waited, "limited": self.limited}
+
+
+class ExpiringCache(object):
+    """Thread safe LRU cache whose entries expire ttl seconds after they
+    were stored."""
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None or item[1] < time.time():
+                self.misses += 1
+                return None
+            self.items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (value, time.time() + self.ttl)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self.items), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+
+class FamilyStore(object):
+    """SQLite store of the edges in public immediate-family responses.
+
+    Each row is one (profile, union, rel) edge of a focus profile's family,
+    together with the profile's gender, name and master flag, the union
+    status and the time it was fetched. Families older than max_age are
+    treated as missing so they are fetched again.
+    """
+    def __init__(self, path, max_age=30 * 24 * 3600):
+        self.path = path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS edges (focus TEXT NOT NULL, profile TEXT NOT NULL, "
+            "union_id TEXT, rel TEXT, gender TEXT, name TEXT, master INTEGER, "
+            "status TEXT, fetched_at REAL NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS edges_focus ON edges (focus)")
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def put_many(self, families):
+        """Replaces the stored edges for each (focus, response) pair."""
+        now = time.time()
+        rows = []
+        for focus, response in families:
+            nodes = response.get("nodes", {})
+            for item in nodes:
+                if not str(item).startswith("profile"):
+                    continue
+                node = nodes[item]
+                gender = node.get("gender")
+                master = 1 if "master_profile" in node else 0
+                name = node.get("name")
+                edges = node.get("edges") or {}
+                # A profile without edges still needs a row to be rebuilt.
+                rows.append((focus, item, None, None, gender, name, master, None, now))
+                for union in edges:
+                    status = None
+                    if union in nodes:
+                        status = nodes[union].get("status")
+                    rows.append((focus, item, union, edges[union]["rel"], gender, name,
+                                 master, status, now))
+        with self.lock:
+            self.db.executemany("DELETE FROM edges WHERE focus = ?",
+                                [(focus,) for focus, response in families])
+            self.db.executemany("INSERT INTO edges VALUES (?,?,?,?,?,?,?,?,?)", rows)
+            self.db.commit()
+
+    def get_many(self, ids):
+        """Returns {focus: response} rebuilt from the fresh stored edges of
+        the given profile ids."""
+        oldest = time.time() - self.max_age
+        found = {}
+        with self.lock:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                rows = self.db.execute(
+                    "SELECT focus, profile, union_id, rel, gender, name, master, status "
+                    "FROM edges WHERE fetched_at >= ? AND focus IN (%s)" % ",".join("?" * len(chunk)),
+                    [oldest] + list(chunk)).fetchall()
+                for focus, profile, union, rel, gender, name, master, status in rows:
+                    response = found.setdefault(focus, {"focus": {"id": focus}, "nodes": {}})
+                    nodes = response["nodes"]
+                    node = nodes.get(profile)
+                    if node is None:
+                        node = nodes[profile] = {"id": profile, "public": True, "edges": {}}
+                        if gender:
+                            node["gender"] = gender
+                        if name:
+                            node["name"] = name
+                        if master:
+                            node["master_profile"] = True
+                    if union:
+                        node["edges"][union] = {"rel": rel}
+                        union_node = nodes.setdefault(union, {"edges": {}})
+                        if status:
+                            union_node["status"] = status
+                        union_node["edges"][profile] = {"rel": rel}
+            self.hits += len(found)
+            self.misses += len(ids) - len(found)
+        return found
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight(object):
+    """Coalesces concurrent immediate-family fetches of the same profile.
+
+    The first caller to claim an id fetches it; callers that claim it while
+    that fetch is in flight wait for its family instead. Only public
+    families are handed over, anything else makes the waiter fetch the id
+    with its own access token.
+    """
+    def __init__(self, timeout=60):
+        self.lock = threading.Lock()
+        self.timeout = timeout
+        self.calls = {}
+        self.fetched = 0
+        self.saved = 0
+        self.refetched = 0
+
+    def claim(self, ids):
+        """Returns the ids this caller must fetch and {id: call} for the
+        ids that are already in flight."""
+        owned = []
+        waiting = {}
+        with self.lock:
+            for profile in ids:
+                call = self.calls.get(profile)
+                if call:
+                    waiting[profile] = call
+                else:
+                    self.calls[profile] = [threading.Event(), None]
+                    owned.append(profile)
+            self.fetched += len(owned)
+        return owned, waiting
+
+    def release(self, owned, families):
+        """Publishes the fetched families to the waiters of owned ids."""
+        shared = {}
+        if isinstance(families, list):
+            for family in families:
+                if family.is_public():
+                    shared[family.get_focus()] = family
+        with self.lock:
+            for profile in owned:
+                call = self.calls.pop(profile, None)
+                if call:
+                    call[1] = shared.get(profile)
+                    call[0].set()
+
+    def wait(self, call):
+        call[0].wait(self.timeout)
+        with self.lock:
+            if call[1]:
+                self.saved += 1
+            else:
+                self.refetched += 1
+        return call[1]
+
+    def stats(self):
+        with self.lock:
+            return {"in_flight": len(self.calls), "fetched": self.fetched, "saved": self.saved,
+                    "refetched": self.refetched}
+
+
 class GeniAPI(object):
+    # One pool for the whole process so batches reuse TLS sessions to
+    # www.geni.com instead of handshaking for every call.
+    pool = ConnectionPool()
+    limiter = RateLimiter()
+    # Profiles this access token was denied, keyed by (access_token, id).
+    denied = ExpiringCache(50000, 6 * 3600)
+    # Parsed immediate families of public profiles, shared by all users.
+    families = ExpiringCache(20000, 24 * 3600)
+    # Optional FamilyStore that keeps crawled families across restarts.
+    store = None
+    # Project pages fetched concurrently while paging.
+    project_prefetch = 4
+    # Immediate-family fetches in flight, shared by all threads.
+    inflight = SingleFlight()
 
     def __init__(self, access_token=None):
         self.access_token = access_token
@@ -103,37 +556,151 @@ class GeniAPI(object):
         return family_list
 
     def get_family_group(self, family_root):
-        query = "profile/immediate-family"
-        ids = ""
+        ids = []
         result = []
         while len(family_root) > 0:
-            ids += family_root.pop() + ","
-        ids = ids[:-1]
-        args = {"ids": ids, "fields": "id,name,gender,master_profile"}
-        family_group = self.request(query, args)
+            ids.append(family_root.pop())
+        ids = self._skip_cached(ids, result)
+        ids = self._skip_denied(ids, result)
+        if not ids:
+            return result
+        # Ids another thread is already fetching are waited for instead of
+        # being fetched twice.
+        owned, waiting = self.inflight.claim(ids)
+        found = []
+        try:
+            if owned:
+                found = self._fetch_family_group(owned)
+        finally:
+            self.inflight.release(owned, found)
+        if found == "Invalid access token":
+            return found
+        result.extend(found)
+        missing = []
+        for profile in waiting:
+            family = self.inflight.wait(waiting[profile])
+            if family:
+                result.append(family)
+            else:
+                missing.append(profile)
+        if missing:
+            found = self._fetch_family_group(missing)
+            if found == "Invalid access token":
+                return found
+            result.extend(found)
+        return result
+
+    def _fetch_family_group(self, ids):
+        query = "profile/immediate-family"
+        result = []
+        found = self._family_result(self.request(query, self._family_args(ids)))
+        if found is None:
+            # Find the private profiles with one visibility lookup instead
+            # of splitting the batch until each one fails on its own.
+            ids = self._apply_visibility(ids, self.request("profile", self._visibility_args(ids)), result)
+            if not ids:
+                return result
+            found = self._family_result(self.request(query, self._family_args(ids)))
+            if found is None:
+                found = []
+                for profile in ids:
+                    single = self._family_result(self.request(query, self._family_args([profile])))
+                    if single is None:
+                        # Still denied on its own: look the profile up so a
+                        # private one gets its "Access Denied" family.
+                        self._apply_visibility([profile], self.get_profile(profile, None, {"fields": "id,name,public"}), result)
+                    elif isinstance(single, list):
+                        found.extend(single)
+        if found == "Invalid access token":
+            return found
+        result.extend(found)
+        return result
+
+    def _family_args(self, ids):
+        return {"ids": ",".join(ids), "fields": "id,name,gender,master_profile,public"}
+
+    def _family_result(self, family_group):
+        """Returns the families in an immediate-family response, the
+        "Invalid access token" message, or None if access was denied."""
         if "error" not in family_group:
-            result = self.process_group(family_group)
+            family_list = self.process_group(family_group)
+            self._remember(family_group, family_list)
+            return family_list
+        if "message" in family_group["error"]:
+            if "Invalid access token" == family_group["error"]["message"]:
+                return "Invalid access token"
+            elif "Access Denied" == family_group["error"]["message"]:
+                return None
+        return []
+
+    def _remember(self, family_group, family_list):
+        """Keeps the public families of a response in the shared cache and
+        the family store."""
+        if "results" in family_group:
+            items = family_group["results"]
         else:
-            if "message" in family_group["error"]:
-                if "Invalid access token"  == family_group["error"]["message"]:
-                    result = "Invalid access token"
-                elif "Access Denied" == family_group["error"]["message"]:
-                    newlist = []
-                    startlist = ids.split(",")
-                    if len(startlist) == 1:
-                        relative = self.get_profile(startlist[0])
-                        if "public" in relative:
-                            if relative["public"] == False:
-                                return [Family("profile", relative, "Access Denied")]
-                            else:
-                                return []
-                        else:
-                            return []
-                    idlist = [startlist[i::2] for i in range(2)]
-                    for family_root in idlist:
-                        newlist.extend(self.get_family_group(family_root))
-                    result = newlist
-        return result
+            items = [family_group]
+        stored = []
+        for item, family in zip(items, family_list):
+            # Only families made entirely of public profiles are safe to
+            # hand to other users.
+            if family.is_public():
+                self.families.put(family.get_focus(), family)
+                stored.append((family.get_focus(), item))
+        if self.store and stored:
+            self.store.put_many(stored)
+
+    def _skip_cached(self, ids, result):
+        """Adds every cached or stored family to result and returns the ids
+        left to fetch."""
+        remaining = []
+        for profile in ids:
+            family = self.families.get(profile)
+            if family:
+                result.append(family)
+            else:
+                remaining.append(profile)
+        if self.store and remaining:
+            stored = self.store.get_many(remaining)
+            if stored:
+                for profile in stored:
+                    family = Family("profile", stored[profile])
+                    self.families.put(profile, family)
+                    result.append(family)
+                remaining = [profile for profile in remaining if profile not in stored]
+        return remaining
+
+    def _skip_denied(self, ids, result):
+        """Adds an "Access Denied" family to result for every id this token
+        is known to be denied and returns the ids left to fetch."""
+        remaining = []
+        for profile in ids:
+            relative = self.denied.get((self.access_token, profile))
+            if relative:
+                result.append(Family("profile", relative, "Access Denied"))
+            else:
+                remaining.append(profile)
+        return remaining
+
+    def _visibility_args(self, ids):
+        return {"ids": ",".join(ids), "fields": "id,name,public"}
+
+    def _apply_visibility(self, ids, response, result):
+        """Records the private profiles in a visibility lookup as denied and
+        returns the ids that are still worth fetching."""
+        if response and "results" in response:
+            profiles = response["results"]
+        elif response and "id" in response:
+            profiles = [response]
+        else:
+            profiles = []
+        private = set()
+        for relative in profiles:
+            if "id" in relative and "public" in relative and relative["public"] == False:
+                self.denied.put((self.access_token, relative["id"]), relative)
+                result.append(Family("profile", relative, "Access Denied"))
+                private.add(relative["id"])
+        return [profile for profile in ids if profile not in private]
 
     def get_parents(self, profile):
         family = self.get_family(profile)
@@ -202,18 +769,23 @@ class GeniAPI(object):
         return info
 
     def get_project_profiles(self, project):
+        return list(self.iter_project_profiles(project))
+
+    def iter_project_profiles(self, project, strict=False):
+        """Yields the profiles of a project page by page. With strict set,
+        raises GeniAPIError if any page fails, rather than stopping."""
         args = {'fields': 'id,name'}
-        proj = Project(project, self.get_project(project, "profiles", args))
-        return proj.get_results()
+        proj = Project(project, self.get_project(project, "profiles", args), self, self.project_prefetch, strict)
+        return proj.iter_results()
 
     def get_project_collaborators(self, project):
         args = {'fields': 'id'}
-        proj = Project(project, self.get_project(project, "collaborators", args))
+        proj = Project(project, self.get_project(project, "collaborators", args), self, self.project_prefetch)
         return proj.get_results()
 
     def get_project_followers(self, project):
         args = {'fields': 'id'}
-        proj = Project(project, self.get_project(project, "followers", args))
+        proj = Project(project, self.get_project(project, "followers", args), self, self.project_prefetch)
         return proj.get_results()
 
     def request(self, path, args=None, post_args=None):
@@ -222,108 +794,369 @@ class GeniAPI(object):
         We translate args to a valid query string. If post_args is given,
         we send a POST request to the given path with the given arguments.
         """
-        args = args or {}
         response = ""
-        if self.access_token:
-            if post_args is not None:
-                post_args["access_token"] = self.access_token
-            else:
-                args["access_token"] = self.access_token
-        post_data = None if post_args is None else urllib.urlencode(post_args)
-        try:
-            file = urllib2.urlopen("https://www.geni.com/api/" + path + "?" +
-                                   urllib.urlencode(args), post_data)
-        except urllib2.HTTPError, e:
-            response = _parse_json(e.read())
-            if "error" in response and "message" in response["error"]:
-                message = response["error"]["message"]
-                if "Rate limit exceeded." == message:
-                    i = 3 #Try it 3 times
-                    while message == "Rate limit exceeded." and i > 0:
-                        time.sleep(3)
-                        i -= 1
-                        try:
-                            file = urllib2.urlopen("https://www.geni.com/api/" + path + "?" +
-                                                   urllib.urlencode(args), post_data)
-                            message = "Pass"
-                        except:
-                            response = _parse_json(e.read())
-                            if "error" in response and "message" in response["error"]:
-                                message = response["error"]["message"]
-                            else:
-                                message = "error"
-                                logging.warning("***** " + path + "?" + urllib.urlencode(args) + " *****")
-                                logging.warning(response)
-                            file = None
-                elif "Access Denied" == message:
-                    file = None
-                else:
-                    logging.warning("***** " + path + "?" + urllib.urlencode(args) + " *****")
-                    logging.warning(response)
-                    file = None
-            else:
-                logging.warning("***** " + path + "?" + urllib.urlencode(args) + " *****")
-                logging.warning(response)
+        url, post_data = self._prepare_request(path, args, post_args)
+        retries = 3
+        while True:
+            self.limiter.acquire()
+            start = time.time()
+            try:
+                file = self.pool.urlopen(url, post_data)
+                self.limiter.update(file.info())
+                self._record(start, file.length)
+                break
+            except urllib2.HTTPError, e:
+                self.limiter.update(e.info())
                 file = None
+                body = e.read()
+                response = _parse_json(body)
+                message = None
+                if "error" in response and "message" in response["error"]:
+                    message = response["error"]["message"]
+                self._record(start, len(body), message or "error")
+                if "Rate limit exceeded." == message and retries > 0:
+                    retries -= 1
+                    self.limiter.backoff()
+                    continue
+                if "Access Denied" != message:
+                    self._log_error(url, response)
+                break
+            except (urllib2.URLError, httplib.HTTPException, socket.error):
+                self._record(start, 0, "connection")
+                raise
 
         try:
             if file:
                 fileInfo = file.info()
-                if fileInfo.maintype == 'text':
-                    response = _parse_json(file.read())
-                elif fileInfo.maintype == 'application':
-                    response = _parse_json(file.read())
-                elif fileInfo.maintype == 'image':
-                    mimetype = fileInfo['content-type']
-                    response = {
-                        "data": file.read(),
-                        "mime-type": mimetype,
-                        "url": file.url,
-                        }
-                else:
-                    logging.warning('Maintype was not text or image')
+                response = self._parse_body(fileInfo.maintype, fileInfo['content-type'],
+                                            file.read(), file.url)
         finally:
             if file:
                 file.close()
         return response
 
+    def _record(self, start, size, error=None):
+        _request_count.inc(1)
+        _request_seconds.observe(time.time() - start)
+        _response_bytes.inc(size)
+        if error:
+            _request_errors.inc(1, _error_reasons.get(error, "other"))
+        if "Rate limit exceeded." == error:
+            _rate_limited.inc(1)
+
+    def _prepare_request(self, path, args=None, post_args=None):
+        """Returns the (url, post_data) pair for a Geni API call."""
+        args = args or {}
+        if self.access_token:
+            if post_args is not None:
+                post_args["access_token"] = self.access_token
+            else:
+                args["access_token"] = self.access_token
+        post_data = None if post_args is None else urllib.urlencode(post_args)
+        return "https://www.geni.com/api/" + path + "?" + urllib.urlencode(args), post_data
+
+    def _parse_body(self, maintype, mimetype, body, url):
+        response = ""
+        if maintype == 'text':
+            response = _parse_json(body)
+        elif maintype == 'application':
+            response = _parse_json(body)
+        elif maintype == 'image':
+            response = {
+                "data": body,
+                "mime-type": mimetype,
+                "url": url,
+                }
+        else:
+            logging.warning('Maintype was not text or image')
+        return response
+
+    def _log_error(self, url, response):
+        logging.warning("***** " + url.split("/api/", 1)[-1] + " *****")
+        logging.warning(response)
+
+    def _split_api_url(self, url):
+        """Splits a full Geni API url (e.g. a next_page link) into the
+        (path, args) pair that request expects."""
+        parts = urlparse.urlsplit(url)
+        path = parts.path.split("/api/", 1)[-1]
+        args = {}
+        for key, value in parse_qs(parts.query).items():
+            if key != "access_token":
+                args[key] = value[-1]
+        return path, args
+
+
+class AsyncGeniAPI(GeniAPI):
+    """Non-blocking counterpart of GeniAPI for code running on the IOLoop.
+
+    Calls take a callback instead of returning their result, so they can be
+    used directly or through tornado.gen.Task. Responses are parsed with the
+    same Family and Project classes as the blocking client. Families are
+    shared through the in-memory cache only: the family store is SQLite and
+    would block the IOLoop.
+    """
+    store = None
+
+    def request(self, path, args=None, post_args=None, callback=None, retries=3):
+        fetch = functools.partial(self._fetch, path, args, post_args, callback, retries)
+        wait = self.limiter.reserve()
+        if wait > 0:
+            tornado.ioloop.IOLoop.instance().add_timeout(time.time() + wait, fetch)
+        else:
+            fetch()
+
+    def _fetch(self, path, args, post_args, callback, retries):
+        url, post_data = self._prepare_request(path, args, post_args)
+        client = tornado.httpclient.AsyncHTTPClient()
+        client.fetch(url, functools.partial(self._on_response, path, args, post_args,
+                                            callback, retries, time.time()),
+                     method="GET" if post_data is None else "POST", body=post_data)
+
+    def _on_response(self, path, args, post_args, callback, retries, start, response):
+        self.limiter.update(response.headers)
+        if response.error:
+            try:
+                error = _parse_json(response.body)
+            except (TypeError, ValueError):
+                error = {"error": {"message": "connection"}}
+            message = None
+            if "error" in error and "message" in error["error"]:
+                message = error["error"]["message"]
+            self._record(start, len(response.body or ""), message or "error")
+            if "Rate limit exceeded." == message and retries > 0:
+                self.limiter.backoff()
+                self.request(path, args, post_args, callback, retries - 1)
+                return
+            if "Access Denied" != message:
+                self._log_error(response.request.url, error)
+            callback(error)
+            return
+        self._record(start, len(response.body or ""))
+        mimetype = response.headers.get("Content-Type", "")
+        callback(self._parse_body(mimetype.split("/")[0], mimetype, response.body,
+                                  response.effective_url))
+
+    def get_profile(self, profile, path=None, args=None, callback=None):
+        if not str(profile).startswith("profile"):
+            profile = "profile-" + profile
+        if path:
+            profile += "/" + path
+        self.request(profile, args, callback=callback)
+
+    def get_project(self, project, path=None, args=None, callback=None):
+        if not str(project).startswith("project"):
+            project = "project-" + project
+        if path:
+            project += "/" + path
+        self.request(project, args, callback=callback)
+
+    def get_family_group(self, family_root, callback=None):
+        ids = []
+        result = []
+        while len(family_root) > 0:
+            ids.append(family_root.pop())
+        ids = self._skip_cached(ids, result)
+        ids = self._skip_denied(ids, result)
+        if not ids:
+            callback(result)
+            return
+        self.request("profile/immediate-family", self._family_args(ids),
+                     callback=functools.partial(self._on_family_group, ids, result, True, callback))
+
+    def _on_family_group(self, ids, result, lookup, callback, family_group):
+        found = self._family_result(family_group)
+        if found is None and lookup:
+            self.request("profile", self._visibility_args(ids),
+                         callback=functools.partial(self._on_visibility, ids, result, callback))
+        elif found is None:
+            self._get_family_each(ids, result, callback)
+        elif found == "Invalid access token":
+            callback(found)
+        else:
+            result.extend(found)
+            callback(result)
+
+    def _on_visibility(self, ids, result, callback, response):
+        ids = self._apply_visibility(ids, response, result)
+        if not ids:
+            callback(result)
+            return
+        self.request("profile/immediate-family", self._family_args(ids),
+                     callback=functools.partial(self._on_family_group, ids, result, False, callback))
+
+    def _get_family_each(self, ids, result, callback):
+        pending = [len(ids)]
+        def finish():
+            pending[0] -= 1
+            if pending[0] == 0:
+                callback(result)
+        def visibility(profile, response):
+            self._apply_visibility([profile], response, result)
+            finish()
+        def collect(profile, family_group):
+            found = self._family_result(family_group)
+            if found is None:
+                # Still denied on its own: look the profile up so a private
+                # one gets its "Access Denied" family.
+                self.get_profile(profile, None, {"fields": "id,name,public"},
+                                 callback=functools.partial(visibility, profile))
+                return
+            if isinstance(found, list):
+                result.extend(found)
+            finish()
+        for profile in ids:
+            self.request("profile/immediate-family", self._family_args([profile]),
+                         callback=functools.partial(collect, profile))
+
+    def get_project_profiles(self, project, callback=None):
+        args = {'fields': 'id,name'}
+        self.get_project(project, "profiles", args,
+                         callback=functools.partial(self._on_project_page, project, [], callback))
+
+    def _on_project_page(self, project, results, callback, response):
+        if "results" in response:
+            results.extend(response["results"])
+        if "next_page" in response:
+            path, args = self._split_api_url(response["next_page"])
+            self.request(path, args, callback=functools.partial(self._on_project_page, project,
+                                                                results, callback))
+            return
+        proj = Project(project, {"results": results})
+        callback(proj.get_results())
+
 class Project(object):
-    def __init__(self, focus, response):
+    """Pages of a project listing (profiles, collaborators, followers).
+
+    Pages are fetched through the given GeniAPI as they are consumed. When
+    next_page links carry a page number, up to prefetch pages are fetched
+    concurrently. A page that fails to load ends the listing and clears
+    complete; with strict set, iter_pages raises GeniAPIError instead of
+    ending quietly.
+    """
+    def __init__(self, focus, response, api=None, prefetch=1, strict=False):
         self.focus = focus
         self.response = response
-        self.profiles = []
-        next = "start"
-        while next:
-            next = self.process_response()
+        self.api = api or GeniAPI()
+        self.prefetch = max(1, prefetch)
+        self.strict = strict
+        self.complete = True
+        self.error = None
+        self.profiles = None
 
     def get_json(self):
         return self.response
 
     def get_results(self):
+        if self.profiles is None:
+            self.profiles = list(self.iter_results())
         return self.profiles
 
-    def process_response(self):
-        next = None
-        for item in self.response:
-            if (item == 'next_page'):
-                next = self.response[item]
-            if (item == 'results'):
-                for xitem in self.response[item]:
-                    name = "(No Name)"
-                    if "name" in xitem:
-                        name = xitem["name"]
-                    self.profiles.append({"id": xitem["id"], "name":name })
-        if next:
-            file = urllib2.urlopen(next)
-            self.response = _parse_json(file.read())
-        return next
+    def iter_results(self):
+        for response in self.iter_pages():
+            for profile in self.process_response(response):
+                yield profile
+
+    def process_response(self, response):
+        profiles = []
+        if "results" in response:
+            for xitem in response["results"]:
+                name = "(No Name)"
+                if "name" in xitem:
+                    name = xitem["name"]
+                profiles.append({"id": xitem["id"], "name": name})
+        return profiles
+
+    def iter_pages(self):
+        response = self.response
+        if not response or "error" in response:
+            self._failed(response)
+        self._check()
+        yield response
+        while "next_page" in response and response["next_page"]:
+            path, args = self.api._split_api_url(response["next_page"])
+            page = args.get("page")
+            if self.prefetch == 1 or not str(page).isdigit():
+                response = self._fetch(path, args)
+                self._check()
+                yield response
+                continue
+            # Fetch the next window of pages at once, but stop at the first
+            # page that has no successor.
+            page = int(page)
+            pages = range(page, page + self.prefetch)
+            if "total_count" in response and response.get("results"):
+                last = -(-int(response["total_count"]) // len(response["results"]))
+                pages = [item for item in pages if item <= last] or [page]
+            for response in self._fetch_pages(path, args, pages):
+                self._check()
+                yield response
+                if "next_page" not in response or not response["next_page"]:
+                    break
+
+    def _fetch(self, path, args):
+        try:
+            response = self.api.request(path, args)
+        except Exception as e:
+            # Handled like an error page, so a prefetch thread cannot die
+            # and leave its page unset.
+            response = {"error": {"message": "connection", "detail": str(e)}}
+        if not response or "error" in response:
+            self._failed(response)
+            return {}
+        return response
+
+    def _failed(self, response):
+        logging.warning("Project " + str(self.focus) + " paging stopped: " + str(response))
+        self.complete = False
+        if self.error is None:
+            self.error = response or {"error": {"message": "Empty response"}}
+
+    def _check(self):
+        if self.strict and not self.complete:
+            raise GeniAPIError(self.error)
+
+    def _fetch_pages(self, path, args, pages):
+        responses = [None] * len(pages)
+        def fetch(i, page):
+            page_args = dict(args)
+            page_args["page"] = str(page)
+            responses[i] = self._fetch(path, page_args)
+        threads = []
+        for i, page in enumerate(pages):
+            thread = threading.Thread(target=fetch, args=(i, page))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return responses
+
+
+# relation -> Family bucket
+_BUCKETS = {
+    "father": "parents", "mother": "parents", "parent": "parents",
+    "brother": "siblings", "sister": "siblings", "sibling": "siblings",
+    "son": "children", "daughter": "children", "child": "children",
+    "husband": "spouses", "wife": "spouses", "spouse": "spouses",
+    }
 
 
 class Family(object):
     def __init__(self, focus, response, error=None):
-        self.unions = []
+        self.unions = {}
         self.family = []
         self.focus = None
+        self.public = False
+        # Relatives sorted by relation once, so the getters don't rescan.
+        # Families are shared through the cache; callers must not modify
+        # the returned lists.
+        self.profiles = {}
+        self.parents = []
+        self.siblings = []
+        self.children = []
+        self.spouses = []
+        self.branch = []
+        self.branch_group = []
         if error:
             profile = None
             name = None
@@ -332,9 +1165,7 @@ class Family(object):
             if "name" in response:
                 name = response["name"]
             if profile:
-                relative = Relative(profile, name, "unknown", False, error)
-                if relative:
-                    self.family.append(relative)
+                self.add_relative(Relative(profile, name, "unknown", False, error))
             else:
                 logging.warning('No id? ' + response)
         else:
@@ -344,11 +1175,11 @@ class Family(object):
                 self.focus = focus
             if not "nodes" in response:
                 return
+            self.public = True
             for item in response["nodes"]:
                 if (str(item).startswith("union")):
                     union = Union(str(item), response["nodes"][item])
-                    if union:
-                        self.unions.append(union)
+                    self.unions[union.get_id()] = union
 
             for item in response["nodes"]:
                 if (str(item).startswith("profile")):
@@ -362,25 +1193,40 @@ class Family(object):
                         master = True
                     if "name" in response["nodes"][item]:
                         name = response["nodes"][item]["name"]
+                    if response["nodes"][item].get("public") != True:
+                        self.public = False
                     for edge in response["nodes"][item]["edges"]:
                         rel = response["nodes"][item]["edges"][edge]["rel"]
                         relative = self.process_unions(edge, item, rel, gender, name, master)
                         if relative:
-                            self.family.append(relative)
+                            self.add_relative(relative)
+
+    def add_relative(self, relative):
+        self.family.append(relative)
+        id = relative.get_id()
+        if id not in self.profiles:
+            self.profiles[id] = relative
+        rel = relative.get_rel()
+        bucket = _BUCKETS.get(rel)
+        if bucket:
+            getattr(self, bucket).append(id)
+        if bucket == "parents" or rel == "sibling":
+            self.branch.append(id)
+        if bucket == "parents" or bucket == "siblings" or relative.get_message():
+            self.branch_group.append(relative)
 
     def get_focus(self):
         return self.focus
 
+    def is_public(self):
+        return self.public
+
     def get_profile(self, profile, gen=0):
-        relative = None
         name = None
         if "id" in profile:
             name = profile["name"]
             profile = profile["id"]
-        for item in self.family:
-            if item.get_id() == profile:
-                relative = item
-                break
+        relative = self.profiles.get(profile)
         if name:
             relative_profile = {"id": relative.get_id(), "relation": relative.get_rel(gen), "name": name}
         else:
@@ -394,61 +1240,22 @@ class Family(object):
         return relatives
 
     def get_family_branch_group(self):
-        relatives = []
-        for relative in self.family:
-            rel = relative.get_rel()
-            id = None
-            if rel == "parent" or rel == "father" or rel == "mother":
-                id = relative.get_id()
-            elif rel == "sibling" or rel == "sister" or rel == "brother":
-                id = relative.get_id()
-            elif relative.get_message():
-                id = relative.get_id()
-            if id:
-                relatives.append(relative)
-        return relatives
+        return self.branch_group
 
     def get_family_branch(self):
-        relatives = []
-        for item in self.family:
-            rel = item.get_rel()
-            if rel == "parent" or rel == "father" or rel == "mother":
-                relatives.append(item.get_id())
-            elif rel == "sibling" or rel == "aunt" or rel == "uncle":
-                relatives.append(item.get_id())
-        return relatives
+        return self.branch
 
     def get_parents(self):
-        relatives = []
-        for item in self.family:
-            rel = item.get_rel()
-            if rel == "father" or rel == "mother" or rel == "parent":
-                relatives.append(item.get_id())
-        return relatives
+        return self.parents
 
     def get_siblings(self):
-        relatives = []
-        for item in self.family:
-            rel = item.get_rel()
-            if rel == "brother" or rel == "sister" or rel == "sibling":
-                relatives.append(item.get_id())
-        return relatives
+        return self.siblings
 
     def get_children(self):
-        relatives = []
-        for item in self.family:
-            rel = item.get_rel()
-            if rel == "son" or rel == "daughter" or rel == "child":
-                relatives.append(item.get_id())
-        return relatives
+        return self.children
 
     def get_spouse(self):
-        relatives = []
-        for item in self.family:
-            rel = item.get_rel()
-            if rel == "wife" or rel == "husband" or rel == "spouse":
-                relatives.append(item.get_id())
-        return relatives
+        return self.spouses
 
     def print_family(self):
         print "\nFocus: " + self.focus
@@ -457,11 +1264,13 @@ class Family(object):
         print "\n"
 
     def process_unions(self, union, profile, rel, gender, name, master=False):
-        for item in self.unions:
-            if union == item.get_id():
-                return item.get_edge(profile, self.focus, rel, gender, name, master)
+        item = self.unions.get(union)
+        if item:
+            return item.get_edge(profile, self.focus, rel, gender, name, master)
 
 class Relative(object):
+    __slots__ = ("id", "relation", "master", "name", "message")
+
     def __init__(self, id, name, relation, master=False, message=False):
         self.id = id
         self.relation = relation
@@ -482,105 +1291,53 @@ class Relative(object):
         return self.message
 
     def get_rel(self, gen=0):
-        if gen == 0:
-            return self.relation
-        else:
-            #todo likely needs some work on half siblings, step parents, gen 1, etc.
-            newrel = self.relation
-            if self.relation == "sister":
-                newrel = "aunt"
-            elif self.relation == "brother":
-                newrel = "uncle"
-            elif self.relation == "sibling":
-                newrel = "aunt/uncle"
-            elif self.relation == "father":
-                newrel = "grandfather"
-            elif self.relation == "mother":
-                newrel = "grandmother"
-            elif self.relation == "wife":
-                newrel = "spouse"
-            elif self.relation == "husband":
-                newrel = "spouse"
-            elif self.relation == "spouse":
-                newrel = "spouse"
-            else:
-                newrel = "aunt/uncle/grandparent"
-        prefix = ""
-        gen -= 1
-        if gen > 0:
-            prefix = "great "
-        if gen > 1:
-            if gen == 2:
-                prefix = "2nd " + prefix
-            elif gen == 3:
-                prefix = "3rd " + prefix
-            elif gen > 3:
-                if gen < 21:
-                    prefix = str(gen) + "th " + prefix
-                elif gen % 10 == 1:
-                    prefix = str(gen) + "st " + prefix
-                elif gen % 10 == 2:
-                    prefix = str(gen) + "nd " + prefix
-                elif gen % 10 == 3:
-                    prefix = str(gen) + "rd " + prefix
-                else:
-                    prefix = str(gen) + "th " + prefix
-        return prefix + newrel
+        return relation_label(self.relation, gen)
+
+
+# (profile's rel, focus's rel) in a union -> relation by gender
+_UNION_RELATIONS = {
+    ("partner", "child"): {"male": "father", "female": "mother", None: "parent"},
+    ("partner", "partner"): {"male": "husband", "female": "wife", None: "spouse"},
+    ("child", "partner"): {"male": "son", "female": "daughter", None: "child"},
+    ("child", "child"): {"male": "brother", "female": "sister", None: "sibling"},
+    }
 
 
 class Union(object):
+    __slots__ = ("id", "edges", "status")
+
     def __init__(self, id, response):
         self.id = id
-        self.edges = []
+        self.edges = {}
         self.status = ""
         if "status" in response:
             self.status = response["status"]
         if "edges" in response:
             for item in response["edges"]:
-                edge = Edge(item, response["edges"][item]["rel"])
-                if edge:
-                    self.edges.append(edge)
+                self.edges[item] = Edge(item, response["edges"][item]["rel"])
 
     def print_union(self):
         print self.id + " (" + self.status + ")"
-        for edge in self.edges:
+        for edge in self.edges.values():
             print "\t" + edge.profile + " (" + edge.rel + ")"
 
     def get_edge(self, profile, focus, rel, gender, name, master=False):
-        for x in self.edges:
-            if focus == x.get_profile() and profile != focus:
-                rel2 = x.get_rel()
-                if (rel == "partner" and rel2 == "child" and gender == "male"):
-                    return Relative(profile, name, "father", master)
-                elif (rel == "partner" and rel2 == "child" and gender == "female"):
-                    return Relative(profile, name, "mother", master)
-                elif (rel == "partner" and rel2 == "child"):
-                    return Relative(profile, name, "parent", master)
-                elif (rel == "partner" and rel2 == "partner" and gender == "male" and self.status == "spouse"):
-                    return Relative(profile, name, "husband", master)
-                elif (rel == "partner" and rel2 == "partner" and gender == "female" and self.status == "spouse"):
-                    return Relative(profile, name, "wife", master)
-                elif (rel == "partner" and rel2 == "partner" and self.status == "spouse"):
-                    return Relative(profile, name, "spouse", master)
-                elif (rel == "child" and rel2 == "partner" and gender == "male"):
-                    return Relative(profile, name, "son", master)
-                elif (rel == "child" and rel2 == "partner" and gender == "female"):
-                    return Relative(profile, name, "daughter", master)
-                elif (rel == "child" and rel2 == "partner"):
-                    return Relative(profile, name, "child", master)
-                elif (rel == "child" and rel2 == "child" and gender == "male"):
-                    return Relative(profile, name, "brother", master)
-                elif (rel == "child" and rel2 == "child" and gender == "female"):
-                    return Relative(profile, name, "sister", master)
-                elif (rel == "child" and rel2 == "child"):
-                    return Relative(profile, name, "sibling", master)
-                else:
-                    return None
+        x = self.edges.get(focus)
+        if x is None or profile == focus:
+            return None
+        relations = _UNION_RELATIONS.get((rel, x.get_rel()))
+        if relations is None:
+            return None
+        if rel == "partner" and x.get_rel() == "partner" and self.status != "spouse":
+            return None
+        return Relative(profile, name, relations.get(gender, relations[None]), master)
 
     def get_id(self):
         return self.id
 
 class Edge(object):
+    __slots__ = ("profile", "rel")
+
     def __init__(self, profile, rel):
         self.profile = profile
         self.rel = rel
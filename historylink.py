@@ -17,14 +17,17 @@
 #Python client library for the Geni Platform.
 
 import base64
+from collections import OrderedDict, deque
 import functools
 import json
 import hashlib
 import hmac
 import time
 import logging
+import math
 import os
 import httplib #for custom error handler
+import Queue
 import threading
 import tornado.database
 import tornado.escape
@@ -40,6 +43,9 @@ from tornado import gen
 from tornado.web import asynchronous
 
 import geni
+import metrics
+import profileset
+import relation
 
 # Find a JSON parser
 try:
@@ -66,9 +72,88 @@ define("geni_canvas_id")
 define("geni_namespace")
 define("app_url")
 define("service_token")
+define("metrics_token")
 define("listenport", type=int)
 define("silent", type=bool)
-define("historyprofiles", type=set)
+define("historyprofiles", type=profileset.LiveIndex)
+define("geni_pool_size", type=int, default=8)
+define("geni_rate", type=float, default=10.0)
+define("geni_burst", type=int, default=10)
+define("geni_denied_ttl", type=int, default=6 * 3600)
+define("geni_family_cache_size", type=int, default=20000)
+define("geni_family_ttl", type=int, default=24 * 3600)
+define("family_store")
+define("family_store_max_age", type=int, default=30 * 24 * 3600)
+define("project_prefetch", type=int, default=4)
+define("worker_threads", type=int, default=16)
+define("search_batches", type=int, default=4)
+define("history_index")
+define("history_index_bloom", type=int, default=10)
+define("link_chunk_size", type=int, default=1000)
+define("refresh_threads", type=int, default=2)
+define("refresh_interval", type=int, default=600)
+define("refresh_period", type=int, default=7 * 24 * 3600)
+define("max_sessions", type=int, default=1000)
+define("session_ttl", type=int, default=3600)
+
+# Project holding the profiles Geni flags as having data problems.
+PROBLEM_PROJECT = 10985
+
+_db_seconds = metrics.registry.histogram(
+    "backend_db_seconds", "Latency of Backend database calls.", ("call",))
+_db_errors = metrics.registry.counter(
+    "backend_db_errors_total", "Backend database calls that raised.", ("call",))
+_searches_active = metrics.registry.gauge(
+    "historylink_searches_active", "HistoryWorker searches running.")
+_search_seconds = metrics.registry.histogram(
+    "historylink_search_seconds", "Wall time of finished searches.",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+_batch_seconds = metrics.registry.histogram(
+    "historylink_batch_seconds", "Wall time of one SubWorker batch, fetch included.")
+_links_loaded = metrics.registry.counter(
+    "backend_links_loaded_total", "Project link rows inserted.")
+_matches = metrics.registry.counter(
+    "historylink_matches_total", "New matches found by searches, by kind.", ("kind",))
+
+
+def _running_searches():
+    return [item for item in LinkHolder.cookie.values() if item.get("running")]
+
+
+metrics.registry.gauge(
+    "historylink_frontier_profiles", "Profiles queued but not yet fetched by running searches.",
+    callback=lambda: sum(len(item.get("familyroot") or []) for item in _running_searches()))
+metrics.registry.gauge(
+    "historylink_frontier_bytes", "Approximate memory held by the visited sets and frontiers of running searches.",
+    callback=lambda: sum(item.familyroot.nbytes() for item in _running_searches()
+                         if hasattr(item.familyroot, "nbytes")))
+metrics.registry.gauge(
+    "historylink_batches_queued", "SubWorker batches waiting for a pool thread.",
+    callback=lambda: HistoryWorker.pool.queue.qsize())
+metrics.registry.gauge(
+    "historylink_search_generation_max", "Deepest generation reached by a running search.",
+    callback=lambda: max([item.get("gen") or 0 for item in _running_searches()] or [0]))
+
+
+def _stats_gauge(name, help, stats):
+    metrics.registry.gauge(name, help, ("stat",), callback=lambda: dict(
+        ((key,), value) for key, value in stats().items()))
+
+_stats_gauge("historylink_sessions", "Search sessions held in memory.", lambda: LinkHolder.cookie.stats())
+metrics.registry.gauge(
+    "historylink_history_profiles", "Profiles in the history profile index.",
+    callback=lambda: len(options.historyprofiles or ()))
+metrics.registry.gauge(
+    "historylink_history_index_bytes", "Size of the history profile index.",
+    callback=lambda: options.historyprofiles.nbytes() if options.historyprofiles else 0)
+_stats_gauge("historylink_refresh", "Background project refreshes.", lambda: ProjectScheduler.instance().stats())
+_stats_gauge("geni_pool", "Geni connection pool counters.", lambda: geni.GeniAPI.pool.stats())
+_stats_gauge("geni_limiter", "Geni rate limiter state.", lambda: geni.GeniAPI.limiter.stats())
+_stats_gauge("geni_family_cache", "Shared immediate-family cache.", lambda: geni.GeniAPI.families.stats())
+_stats_gauge("geni_denied_cache", "Denied profile cache.", lambda: geni.GeniAPI.denied.stats())
+_stats_gauge("geni_coalesced", "Coalesced immediate-family fetches.", lambda: geni.GeniAPI.inflight.stats())
+_stats_gauge("geni_family_store", "On-disk family store.",
+             lambda: geni.GeniAPI.store.stats() if geni.GeniAPI.store else {})
 
 #class GeniApplication(tornado.wsgi.WSGIApplication):
 class GeniApplication(tornado.web.Application):
@@ -99,6 +184,7 @@ class GeniApplication(tornado.web.Application):
             tornado.web.url(r"/projectsubmit", ProjectSubmit),
             tornado.web.url(r"/projectlist", ProjectList),
             tornado.web.url(r"/treecomplete", TreeComplete),
+            tornado.web.url(r"/metrics", MetricsHandler),
             tornado.web.url(r"/login", LoginHandler, name="login"),
             tornado.web.url(r"/logout", LogoutHandler, name="logout"),
             tornado.web.url(r"/geni", GeniCanvasHandler),
@@ -131,159 +217,271 @@ class ErrorHandler(tornado.web.RequestHandler):
 ## override the tornado.web.ErrorHandler with our default ErrorHandler
 tornado.web.ErrorHandler = ErrorHandler
 
+class MatchStore(object):
+    """Matches of one search in the order they were found, indexed by
+    profile id, with a running count of matches per project. Callers hold
+    the session lock.
+    """
+    __slots__ = ("items", "index", "projects")
+
+    def __init__(self):
+        self.items = []
+        self.index = {}
+        self.projects = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, profile):
+        """Stores profile, or updates the relation of the stored match for
+        the same id. Returns True if the id was already stored."""
+        items = self.index.get(profile["id"])
+        if items is None:
+            self.index[profile["id"]] = profile
+            self.items.append(profile)
+            if not profile["message"]:
+                for project in profile["projects"]:
+                    if int(project["id"]) in self.projects:
+                        self.projects[int(project["id"])]["count"] += 1
+                    else:
+                        self.projects[int(project["id"])] = {"count": 1, "name": project["name"]}
+            return None
+        #Give more weight to parents over aunts/uncles
+        if profile["message"]:
+            pass
+        elif "aunt" in profile["relation"]:
+            pass
+        elif "uncle" in profile["relation"]:
+            pass
+        elif "mother" in items["relation"]:
+            pass
+        elif "father" in items["relation"]:
+            pass
+        elif items["relation"] != profile["relation"]:
+            items["relation"] = profile["relation"]
+        return True
+
+class Completeness(object):
+    """Direct ancestors found per generation for the Tree Completeness table.
+
+    paths[gen][profile] counts the distinct lines of descent through which
+    profile was reached at generation gen; an ancestor reached through
+    several children counts once for each. found[gen] is the number of
+    parents found for generation gen, weighted by those counts, out of an
+    expected 2 ** (gen + 1). Written by the search thread only.
+    """
+    __slots__ = ("paths", "found")
+
+    def __init__(self):
+        self.paths = {}
+        self.found = []
+
+    def add(self, gen, parents, multiplicity=1):
+        """Counts the parents of a profile reached through multiplicity
+        paths at generation gen."""
+        while len(self.found) <= gen:
+            self.found.append(0)
+        self.found[gen] += len(parents) * multiplicity
+        paths = self.paths.setdefault(gen + 1, {})
+        for parent in parents:
+            paths[parent] = paths.get(parent, 0) + multiplicity
+
+    def pop(self, gen):
+        """Returns and forgets the path counts of generation gen."""
+        return self.paths.pop(gen, {})
+
+    def rows(self, upto):
+        """Table rows for the generations below upto with parents found."""
+        rows = []
+        found_total = 0
+        for gen, found in enumerate(self.found[:upto]):
+            if not found:
+                continue
+            found_total += found
+            expected = 2 ** (gen + 1)
+            expected_total = 2 ** (gen + 2) - 2
+            rows.append({"label": relation.generation_label(gen) + "s",
+                         "found": found, "expected": expected,
+                         "percent": int(round(float(found) / expected * 100)),
+                         "found_total": found_total, "expected_total": expected_total,
+                         "total_percent": int(round(float(found_total) / expected_total * 100))})
+        return rows
+
+class SearchSession(object):
+    """State of one user's search, shared by the request handlers, the
+    HistoryWorker and its SubWorker batches.
+
+    Read-modify-write updates go through the session lock; incr is the
+    atomic form for counters.
+    """
+    __slots__ = ("lock", "used", "count", "running", "stage", "hits", "gen",
+                 "master", "project", "problem", "complete", "limit", "rootprofile",
+                 "matches", "completeness", "familyroot")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.used = time.time()
+        self.count = 0
+        self.running = 0
+        self.stage = "parent's family"
+        self.hits = 0
+        self.gen = None
+        self.master = None
+        self.project = None
+        self.problem = None
+        self.complete = None
+        self.limit = None
+        self.rootprofile = None
+        self.matches = MatchStore()
+        self.completeness = Completeness()
+        self.familyroot = []
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            value = getattr(self, key) + amount
+            setattr(self, key, value)
+        return value
+
+class SessionRegistry(object):
+    """SearchSessions by user id, least recently used first.
+
+    Sessions unused for ttl seconds are dropped, and the least recently
+    used idle ones go once there are more than maxsize. Running searches
+    are never evicted.
+    """
+    def __init__(self, maxsize=1000, ttl=3600):
+        self.lock = threading.Lock()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.evictions = 0
+
+    def __contains__(self, id):
+        return self.find(id) is not None
+
+    def find(self, id):
+        with self.lock:
+            session = self.sessions.pop(id, None)
+            if session is None:
+                return None
+            if session.running or session.used + self.ttl >= time.time():
+                session.used = time.time()
+                self.sessions[id] = session
+                return session
+            self.evictions += 1
+            return None
+
+    def session(self, id):
+        session = self.find(id)
+        if session is not None:
+            return session
+        with self.lock:
+            session = self.sessions.get(id)
+            if session is None:
+                session = self.sessions[id] = SearchSession()
+                self.evict()
+            return session
+
+    def evict(self):
+        expired = time.time() - self.ttl
+        idle = [id for id, session in self.sessions.items() if not session.running]
+        for id in idle:
+            if self.sessions[id].used >= expired and len(self.sessions) <= self.maxsize:
+                break
+            del self.sessions[id]
+            self.evictions += 1
+
+    def remove(self, id):
+        with self.lock:
+            self.sessions.pop(id, None)
+
+    def values(self):
+        with self.lock:
+            return self.sessions.values()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.sessions), "evictions": self.evictions,
+                    "running": len([item for item in self.sessions.values() if item.running])}
+
 class LinkHolder(object):
-    cookie = {}
+    cookie = SessionRegistry()
 
     def set(self, id, key, value):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        self.cookie[id][key] = value
+        setattr(self.cookie.session(id), key, value)
+
+    def incr(self, id, key, amount=1):
+        return self.cookie.session(id).incr(key, amount)
 
     def add_matches(self, id, profile):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "matches" in self.cookie[id]:
-            self.cookie[id]["matches"] = []
-        exists = None
-        if "hits" in self.cookie[id]:
-            self.cookie[id]["hits"] += 1
-        else:
-            self.cookie[id]["hits"] = 1
-        for items in self.cookie[id]["matches"]:
-            if items["id"] == profile["id"]:
-                #Give more weight to parents over aunts/uncles
-                exists = True
-                if profile["message"]:
-                    pass
-                elif "aunt" in profile["relation"]:
-                    pass
-                elif "uncle" in profile["relation"]:
-                    pass
-                elif "mother" in items["relation"]:
-                    pass
-                elif "father" in items["relation"]:
-                    pass
-                else:
-                    items["relation"] = profile["relation"]
+        session = self.cookie.session(id)
+        with session.lock:
+            session.hits += 1
+            exists = session.matches.add(profile)
         if not exists:
-            self.cookie[id]["matches"].append(profile)
+            if profile["message"]:
+                _matches.inc(1, profile["message"])
+            else:
+                _matches.inc(1, "Project")
         return exists
 
-    def add_parentmatch(self, id, gen, profile):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "parentmatches" in self.cookie[id]:
-            self.cookie[id]["parentmatches"] = {}
-        if not gen in self.cookie[id]["parentmatches"]:
-            self.cookie[id]["parentmatches"][gen] = {}
-        if not profile in self.cookie[id]["parentmatches"][gen]:
-            self.cookie[id]["parentmatches"][gen][profile] = 1
-        else:
-            self.cookie[id]["parentmatches"][gen][profile] += 1
-
-    def get_parentmatch(self, id, gen, profile):
-        if not id in self.cookie:
-            return 0
-        if not "parentmatches" in self.cookie[id]:
-            return 0
-        if not gen in self.cookie[id]["parentmatches"]:
-            return 0
-        if not profile in self.cookie[id]["parentmatches"][gen]:
-            return 0
-        return self.cookie[id]["parentmatches"][gen][profile]
-
-    def remove_parentmatch(self, id, gen):
-        if not id in self.cookie:
-            return
-        if not "parentmatches" in self.cookie[id]:
-            return
-        if not gen in self.cookie[id]["parentmatches"]:
-            return
-        else:
-            self.cookie[id]["parentmatches"][gen] = {}
-        return
+    def get_completeness(self, id):
+        return self.cookie.session(id).completeness
 
     def get_matches(self, id):
-        if not id in self.cookie:
+        session = self.cookie.find(id)
+        if not session:
             return []
-        if not "matches" in self.cookie[id]:
-            return []
-        return self.cookie[id]["matches"]
+        with session.lock:
+            return list(session.matches.items)
+
+    def get_projectcounts(self, id):
+        session = self.cookie.find(id)
+        if not session:
+            return {}
+        with session.lock:
+            return dict((key, dict(value)) for key, value in session.matches.projects.items())
 
     def get_matchcount(self, id):
-        if not id in self.cookie:
+        session = self.cookie.find(id)
+        if not session:
             return 0
-        if not "matches" in self.cookie[id]:
-            return 0
-        return len(self.cookie[id]["matches"])
-
-    def addParentCount(self, id, gen, parentcount):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "gencount" in self.cookie[id]:
-            self.cookie[id]["gencount"] = {}
-        if not str(gen) in self.cookie[id]["gencount"]:
-            self.cookie[id]["gencount"][str(gen)] = {}
-            self.cookie[id]["gencount"][str(gen)]["count"] = parentcount
-            self.cookie[id]["gencount"][str(gen)]["label"] = str(self.getGeneration(gen)) + "s"
-        else:
-            self.cookie[id]["gencount"][str(gen)]["count"] += parentcount
+        return len(session.matches)
 
-    def getParentCount(self, id):
-        if not id in self.cookie:
-            return None
-        if not "gencount" in self.cookie[id]:
-            return None
-        return self.cookie[id]["gencount"]
+    def get_completeness_rows(self, id):
+        session = self.cookie.find(id)
+        if not session or session.gen is None:
+            return []
+        return session.completeness.rows(session.gen)
 
     def set_familyroot(self, id, root):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        self.cookie[id]["familyroot"] = root
+        self.cookie.session(id).familyroot = root
 
     def append_familyroot(self, id, profile):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "familyroot" in self.cookie[id]:
-            self.cookie[id]["familyroot"] = []
-        self.cookie[id]["familyroot"].append(profile)
+        session = self.cookie.session(id)
+        with session.lock:
+            session.familyroot.append(profile)
 
     def get_familyroot(self, id):
-        if not id in self.cookie:
-            return []
-        if not "familyroot" in self.cookie[id]:
+        session = self.cookie.find(id)
+        if not session:
             return []
-        return self.cookie[id]["familyroot"]
-
-    def add_history(self, id, history):
-        if not id in self.cookie:
-            self.cookie[id] = {}
-        if not "history" in self.cookie[id]:
-            self.cookie[id]["history"] = set(history)
-        else:
-            self.cookie[id]["history"].update(history)
-
-    def get_history(self, id):
-        if not id in self.cookie:
-            return set([])
-        if not "history" in self.cookie[id]:
-            return set([])
-        return self.cookie[id]["history"]
+        return session.familyroot
 
     def reset_matchhit(self, id):
-        if not id in self.cookie:
+        session = self.cookie.find(id)
+        if not session:
             return
-            #if "matches" in self.cookie[id]:
-            #self.cookie[id]["matches"] = []
-        if "hits" in self.cookie[id]:
-            self.cookie[id]["hits"] = 0
+        session.hits = 0
         return
 
     def get(self, id, key):
-        if id in self.cookie:
-
-            if key in self.cookie[id]:
-                return self.cookie[id][key]
+        session = self.cookie.find(id)
+        if session:
+            return session.get(key)
         if key == "count":
             return 0
         elif key == "stage":
@@ -296,40 +494,14 @@ class LinkHolder(object):
             return None
 
     def getGeneration(self, gen):
-        stage = "parent"
-        if gen < 0:
-            stage = "profile"
-        elif gen == 1:
-            stage = "grand parent"
-        elif gen == 2:
-            stage = "great grandparent"
-        elif gen > 2:
-            stage = self.genPrefix(gen) + " great grandparent"
-        return stage
+        return relation.generation_label(gen)
 
     def genPrefix(self, gen):
-        gen -= 1
-        value = ""
-        if gen == 2:
-            value = str(gen) + "nd"
-        elif gen == 3:
-            value = str(gen) + "rd"
-        elif gen > 3:
-            if gen < 21:
-                value =  str(gen) + "th"
-            elif gen % 10 == 1:
-                value = str(gen) + "st"
-            elif gen % 10 == 2:
-                value = str(gen) + "nd"
-            elif gen % 10 == 3:
-                value = str(gen) + "rd"
-            else:
-                value = str(gen) + "th"
-        return value
+        return relation.generation_prefix(gen)
 
     def stop(self, id):
-        if id and id in self.cookie:
-            del self.cookie[id]
+        if id:
+            self.cookie.remove(id)
 
 class BaseHandler(tornado.web.RequestHandler):
     @property
@@ -421,19 +593,14 @@ class HomeHandler(BaseHandler):
 class ProjectUpdate(BaseHandler):
     @tornado.web.asynchronous
     def get(self):
+        scheduler = ProjectScheduler.instance()
+        if self.get_argument("status", None):
+            self.set_header("Cache-control", "no-cache")
+            self.write_json(scheduler.status())
+            return
         self.write("update initiated")
         self.finish()
-        user = self.current_user
-        if not user:
-            user = {'id': options.geni_app_id, 'access_token': options.service_token, 'name': "HistoryLink App"}
-        projects = self.backend.get_projectlist()
-        for item in projects:
-            try:
-                print "Updating Project: " + item["name"]
-            except:
-                print "Updating Project: project-" + str(item["id"])
-            self.backend.add_project(str(item["id"]), user)
-        options.historyprofiles = set(self.backend.get_history_profiles())
+        scheduler.schedule(user=self.current_user)
 
 class ProjectSubmit(BaseHandler):
     @tornado.web.asynchronous
@@ -445,10 +612,13 @@ class ProjectSubmit(BaseHandler):
             logging.info(" *** " +  str(user["name"]) + " (" + str(user["id"]) + ") submitted project " + project)
         except:
             pass
-        if not project:
+        if not project or not project.isdigit():
             self.finish()
-        args = {"user": user, "base": self, "project": project}
-        ProjectWorker(self.worker_done, args).start()
+            return
+        # Submitted projects go through the scheduler so they never refresh
+        # alongside a scheduled refresh of the same project.
+        item = {"id": int(project), "name": "project-" + project}
+        ProjectScheduler.instance().enqueue([item], user, self.worker_done)
 
     def worker_done(self, value):
         try:
@@ -456,23 +626,6 @@ class ProjectSubmit(BaseHandler):
         except:
             return
 
-class ProjectWorker(threading.Thread):
-    user = None
-    base = None
-    project = None
-    def __init__(self, callback=None, *args, **kwargs):
-        self.user = args[0]["user"]
-        self.base = args[0]["base"]
-        self.project = args[0]["project"]
-        args = {}
-        super(ProjectWorker, self).__init__(*args, **kwargs)
-        self.callback = callback
-
-    def run(self):
-        self.base.backend.add_project(self.project, self.user)
-        options.historyprofiles = set(self.base.backend.get_history_profiles())
-        self.callback('DONE')
-
 class ProjectHandler(BaseHandler):
     @tornado.web.authenticated
     @tornado.web.asynchronous
@@ -501,9 +654,27 @@ class TreeComplete(BaseHandler):
     def get(self):
         user = self.current_user
         cookie = self.application.linkHolder
-        parentcount = cookie.getParentCount(user["id"])
-        gen = cookie.get(user["id"], "gen")
-        self.render("treecomplete.html", parentcount=parentcount, gen=gen)
+        rows = cookie.get_completeness_rows(user["id"])
+        self.render("treecomplete.html", rows=rows)
+
+class MetricsHandler(BaseHandler):
+    """Serves the metrics to local scrapers, or to any scraper that sends
+    metrics_token as ?token= or a Bearer Authorization header."""
+    def get(self):
+        if self.request.remote_ip not in ("127.0.0.1", "::1") and not self.has_token():
+            raise tornado.web.HTTPError(403)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.set_header("Cache-control", "no-cache")
+        self.finish(metrics.registry.render())
+
+    def has_token(self):
+        if not options.metrics_token:
+            return False
+        token = self.get_argument("token", None)
+        authorization = self.request.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            token = authorization[len("Bearer "):]
+        return token is not None and hmac.compare_digest(str(token), str(options.metrics_token))
 
 class HistoryHandler(BaseHandler):
     @tornado.web.authenticated
@@ -533,27 +704,18 @@ class HistoryList(BaseHandler):
         who = "is your"
         if profile != user["id"]:
             who = None
-        i = 1
-        projects = {}
-        for item in matches:
+        for item in matches[max(showmatch, 0):]:
             if item["message"]:
-                if (i > showmatch):
-                    try:
-                        logging.info(" *** " + str(item["message"]) + " Match for " +  str(user["name"]) + " on " + str(item["id"]) + ": " + item["name"])
-                    except:
-                        pass
+                try:
+                    logging.info(" *** " + str(item["message"]) + " Match for " +  str(user["name"]) + " on " + str(item["id"]) + ": " + item["name"])
+                except:
+                    pass
             else:
-                if (i > showmatch):
-                    try:
-                        logging.info(" *** Project Match for " +  str(user["name"]) + " on " + str(item["id"]) + ": " + item["name"])
-                    except:
-                        pass
-                for project in item["projects"]:
-                    if project["id"] in projects:
-                        projects[int(project["id"])]["count"] += 1
-                    else:
-                        projects[int(project["id"])] = {"count": 1, "name": project["name"]}
-            i += 1
+                try:
+                    logging.info(" *** Project Match for " +  str(user["name"]) + " on " + str(item["id"]) + ": " + item["name"])
+                except:
+                    pass
+        projects = cookie.get_projectcounts(user["id"])
         cookie.reset_matchhit(user["id"])
         self.render("historylist.html", matches=matches, who=who, projects=projects)
 
@@ -623,8 +785,6 @@ class HistoryProcess(BaseHandler):
         self.application.linkHolder.set(user["id"], "complete", complete)
         self.application.linkHolder.set(user["id"], "limit", limit)
         self.application.linkHolder.set(user["id"], "rootprofile", profile)
-        if not options.historyprofiles:
-            options.historyprofiles = set(self.backend.get_history_profiles())
         if not profile:
             profile = user["id"]
         args = {"user": user, "base": self}
@@ -636,10 +796,200 @@ class HistoryProcess(BaseHandler):
         except:
             return
 
+class WorkerPool(object):
+    """Long-lived threads shared by every search, fed from one job queue.
+
+    Jobs are objects with a run method. submit puts the job on the queue;
+    once it has run, the job is put on the caller's done queue so the
+    caller can block instead of polling.
+    """
+    def __init__(self, size=16):
+        self.size = size
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work, name="worker-%d" % len(self.threads))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, job, done=None):
+        if len(self.threads) < self.size:
+            self.start()
+        self.queue.put((job, done))
+
+    def work(self):
+        while True:
+            job, done = self.queue.get()
+            try:
+                job.run()
+            except Exception:
+                logging.exception("Worker job failed")
+            finally:
+                if done is not None:
+                    done.put(job)
+
+class RefreshJob(object):
+    def __init__(self, scheduler, project, user=None):
+        self.scheduler = scheduler
+        self.project = project
+        self.user = user
+
+    def run(self):
+        self.scheduler.refresh(self.project, self.user)
+
+class ScheduleJob(object):
+    def __init__(self, scheduler, age=0, paced=False, user=None):
+        self.scheduler = scheduler
+        self.age = age
+        self.paced = paced
+        self.user = user
+
+    def run(self):
+        self.scheduler.queue_stale(self.age, self.paced, self.user)
+
+class ProjectScheduler(object):
+    """Refreshes projects in the background on its own WorkerPool.
+
+    Every interval seconds, tick queues the projects not refreshed for
+    period seconds, least recently refreshed and then largest first, and
+    only as many as it takes for every project to come round once per
+    period. The projects are looked up on the pool, off the IOLoop, and
+    submitted projects are queued here too, so a project is never
+    refreshed twice at once. projects.refreshed is the only state kept, so after a restart
+    the oldest projects are simply picked up again. When the queue drains,
+    the history index is rebuilt if it has gone stale.
+    """
+    def __init__(self, size=2, interval=600, period=7 * 24 * 3600):
+        self.pool = WorkerPool(size)
+        self.interval = interval
+        self.period = period
+        self.lock = threading.Lock()
+        self.queued = OrderedDict()
+        self.running = {}
+        self.callbacks = {}
+        self.refreshed = 0
+        self.failed = 0
+        self.changed = False
+        self.timings = deque(maxlen=100)
+        self.timer = None
+
+    @classmethod
+    def instance(cls):
+        if not hasattr(cls, "_instance"):
+            cls._instance = cls()
+        return cls._instance
+
+    @property
+    def backend(self):
+        return Backend.instance()
+
+    def start(self):
+        self.timer = tornado.ioloop.PeriodicCallback(self.tick, self.interval * 1000)
+        self.timer.start()
+
+    def tick(self):
+        self.schedule(self.period, True)
+
+    def schedule(self, age=0, paced=False, user=None):
+        """Queues the projects not refreshed for age seconds from a pool
+        thread; when paced, only this interval's share of them."""
+        self.pool.submit(ScheduleJob(self, age, paced, user))
+
+    def queue_stale(self, age=0, paced=False, user=None):
+        projects = self.backend.get_stale_projects(age)
+        if paced:
+            total = len(self.backend.get_projectlist())
+            share = int(math.ceil(float(total) * self.interval / self.period))
+            with self.lock:
+                share -= len(self.queued) + len(self.running)
+            projects = projects[:max(share, 0)]
+        self.enqueue(projects, user)
+
+    def enqueue(self, projects, user=None, callback=None):
+        """Queues projects for refresh in the order given, skipping any
+        already queued or running. callback is called with 'DONE' on the
+        IOLoop once every one of them has been refreshed."""
+        waiting = set()
+        with self.lock:
+            for item in projects:
+                waiting.add(item["id"])
+                if item["id"] in self.queued or item["id"] in self.running:
+                    continue
+                self.queued[item["id"]] = item
+                self.pool.submit(RefreshJob(self, item, user))
+            if callback and waiting:
+                waiter = [waiting, callback]
+                for id in waiting:
+                    self.callbacks.setdefault(id, []).append(waiter)
+        if callback and not waiting:
+            tornado.ioloop.IOLoop.instance().add_callback(functools.partial(callback, 'DONE'))
+
+    def refresh(self, project, user=None):
+        if not user:
+            user = {'id': options.geni_app_id, 'access_token': options.service_token, 'name': "HistoryLink App"}
+        with self.lock:
+            self.queued.pop(project["id"], None)
+            self.running[project["id"]] = time.time()
+        try:
+            logging.info("Updating Project: " + project["name"])
+        except:
+            logging.info("Updating Project: project-" + str(project["id"]))
+        start = time.time()
+        ok = False
+        try:
+            # add_project returns False when paging failed part way.
+            ok = self.backend.add_project(str(project["id"]), user) is not False
+        except Exception:
+            logging.exception("Refresh of project-%s failed" % project["id"])
+        with self.lock:
+            del self.running[project["id"]]
+            if ok:
+                self.refreshed += 1
+                self.changed = True
+            else:
+                self.failed += 1
+            self.timings.append({"id": project["id"], "name": project["name"], "ok": ok,
+                                 "seconds": round(time.time() - start, 1), "finished": int(time.time())})
+            done = []
+            for waiter in self.callbacks.pop(project["id"], []):
+                waiter[0].discard(project["id"])
+                if not waiter[0]:
+                    done.append(waiter[1])
+            rebuild = self.changed and not self.queued and not self.running
+            if rebuild:
+                self.changed = False
+        for callback in done:
+            tornado.ioloop.IOLoop.instance().add_callback(functools.partial(callback, 'DONE'))
+        # add_project keeps the index current; rebuild it once the changes
+        # on top of it have grown large.
+        if rebuild and (not options.historyprofiles or options.historyprofiles.stale()):
+            self.backend.rebuild_history_index()
+
+    def stats(self):
+        with self.lock:
+            return {"queued": len(self.queued), "running": len(self.running),
+                    "refreshed": self.refreshed, "failed": self.failed}
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            return {"queued": [{"id": item["id"], "name": item["name"]} for item in self.queued.values()],
+                    "running": [{"id": id, "seconds": round(now - start, 1)} for id, start in self.running.items()],
+                    "refreshed": self.refreshed, "failed": self.failed,
+                    "interval": self.interval, "period": self.period,
+                    "recent": list(reversed(self.timings))}
+
 class HistoryWorker(threading.Thread):
     user = None
     base = None
     cookie = None
+    # Runs the SubWorker batches of every search.
+    pool = WorkerPool()
 
     def __init__(self, callback=None, *args, **kwargs):
         self.user = args[0]["user"]
@@ -650,33 +1000,93 @@ class HistoryWorker(threading.Thread):
         self.callback = callback
 
     def run(self):
+        _searches_active.inc()
+        start = time.time()
+        try:
+            self.search()
+        except Exception:
+            # Free the session and end the request rather than leave both
+            # waiting on a search that has died.
+            logging.exception("Search for " + str(self.user["id"]) + " failed")
+            self.cookie.set(self.user["id"], "running", 0)
+            self.callback('DONE')
+        finally:
+            _searches_active.dec()
+            _search_seconds.observe(time.time() - start)
+
+    def search(self):
         profile = self.user["id"]
+        # Built here rather than in the handler to keep it off the IOLoop.
+        self.base.backend.ensure_history_index()
         rootprofile = self.cookie.get(profile, "rootprofile")
         if not rootprofile:
             rootprofile = profile
-        self.cookie.set_familyroot(profile, [rootprofile])
         limit = self.cookie.get(profile, "limit")
-        #family_root.append(rootprofile)
+        complete = self.cookie.get(profile, "complete")
+        frontier = Frontier(rootprofile, int(limit) if limit else None)
+        self.cookie.set_familyroot(profile, frontier)
+        # (focus, parents) of the families searched at each generation and
+        # the parents of every family searched, for tree completeness.
+        families = {}
+        self.parents = {}
         gen = 0
         self.setGeneration(gen)
-        self.cookie.remove_parentmatch(profile, gen-1)
-        while len(self.cookie.get_familyroot(profile)) > 0:
-            root = []
-            root.extend(self.cookie.get_familyroot(profile))
-            self.cookie.set_familyroot(profile, [])
-
-            threads = 4
-            profilesAtOnce = 10
-            if not limit or int(limit) >= gen:
-                self.threadme(root, threads, profilesAtOnce)
-                if (len(self.cookie.get_familyroot(profile)) > 0):
-                    gen += 1
+        self.cookie.set(profile, "completeness", Completeness())
+        done = Queue.Queue()
+        pending = 0
+        while not self.checkdone():
+            # Hand out batches as soon as their profiles are known instead
+            # of waiting for the whole generation to finish.
+            while pending < options.search_batches:
+                batch = frontier.next_batch(10)
+                if not batch:
+                    break
+                self.pool.submit(SubWorker(self, batch[1], batch[0]), done)
+                pending += 1
+            if not pending:
+                break
+            worker = done.get()
+            pending -= 1
+            frontier.finish(worker.gen)
+            for focus, parents, rematch in worker.found:
+                if not rematch:
+                    for parent in parents:
+                        frontier.add(parent, worker.gen + 1)
+                if complete and focus:
+                    families.setdefault(worker.gen, []).append((focus, parents))
+                    self.parents[focus] = parents
+            for closed in frontier.close():
+                if complete:
+                    self.account(closed, families.pop(closed, []))
+                if closed + 1 <= frontier.deepest:
+                    gen = closed + 1
                     self.setGeneration(gen)
+        gen = frontier.deepest
+        self.cookie.set(profile, "gen", gen)
         # Set the display for the completed Generation
         self.setGenerationLabel(gen-1)
         self.cookie.set(profile, "running", 0)
+        logging.info("Geni connection pool: " + str(geni.GeniAPI.pool.stats()))
+        logging.info("Geni rate limiter: " + str(geni.GeniAPI.limiter.stats()))
+        logging.info("Geni family cache: " + str(geni.GeniAPI.families.stats()))
+        logging.info("Geni coalesced fetches: " + str(geni.GeniAPI.inflight.stats()))
+        if geni.GeniAPI.store:
+            logging.info("Geni family store: " + str(geni.GeniAPI.store.stats()))
         self.callback('DONE')
 
+    def account(self, gen, families):
+        """Adds the parents found for generation gen to the completeness
+        counts, once every family of that generation is in."""
+        completeness = self.cookie.get_completeness(self.user["id"])
+        paths = completeness.pop(gen)
+        for focus, parents in families:
+            completeness.add(gen, parents, paths.pop(focus, 0) or 1)
+        # Ancestors reached again at this generation were searched at an
+        # earlier one; count their parents here as well.
+        for focus, multiplicity in paths.items():
+            if focus in self.parents:
+                completeness.add(gen, self.parents[focus], multiplicity)
+
     def checkdone(self):
         if (self.cookie.get(self.user["id"], "running") == 0):
             return True
@@ -700,59 +1110,35 @@ class HistoryWorker(threading.Thread):
                 match.append(item)
         return match
 
-    def threadme(self, root, threadlimit=None, idlimit=10, timeout=0.05):
-        assert threadlimit > 0, "need at least one thread";
-        printlock = threading.Lock()
-        threadpool = []
-
-        # keep going while work to do or being done
-        while root or threadpool:
-            done = self.checkdone()
-            if done:
-                break
-            parent_list = []
-            # while there's room, remove source files
-            # and add to the pool
-            while root and (threadlimit is None or len(threadpool) < threadlimit):
-                i = idlimit
-                sub_root = []
-                while i > 0:
-                    sub_root.append(root.pop())
-                    if len(root) > 0:
-                        i -= 1
-                    else:
-                        i = 0
-                wrkr = SubWorker(self, sub_root, printlock)
-                wrkr.start()
-                threadpool.append(wrkr)
-
-            # remove completed threads from the pool
-            for thr in threadpool:
-                thr.join(timeout=timeout)
-                if not thr.is_alive():
-                    threadpool.remove(thr)
-                    #print("all threads are done")
-
-class SubWorker(threading.Thread):
-    def __init__(self, root, family_list, printlock,**kwargs):
-        super(SubWorker,self).__init__(**kwargs)
+class SubWorker(object):
+    def __init__(self, root, family_list, gen):
         self.root = root
         self.family_list = family_list
-        self.lock = printlock # so threads don't step on each other's prints
+        self.gen = gen
+        # (focus, parents, rematch) for every family searched
+        self.found = []
 
     def run(self):
-        #with self.lock:
         profile = self.root.user["id"]
         if not profile:
             return
         running = self.root.cookie.get(profile, "running")
         if running == 0:
             return
+        start = time.time()
+        try:
+            self.process()
+        finally:
+            _batch_seconds.observe(time.time() - start)
+
+    def process(self):
+        profile = self.root.user["id"]
+        gen = self.gen
         the_group = self.root.base.backend.get_family_group(self.family_list, self.root.user)
         master = self.root.cookie.get(profile, "master")
         problem = self.root.cookie.get(profile, "problem")
         project = self.root.cookie.get(profile, "project")
-        complete = self.root.cookie.get(profile, "complete")
+        index = options.historyprofiles
         if the_group=="Invalid access token":
             self.root.cookie.stop(profile)
             self.root.base.set_secure_cookie("access_token", "")
@@ -761,36 +1147,18 @@ class SubWorker(threading.Thread):
         if the_group:
             for this_family in the_group:
                 rematch = None
-                rootprofile = None
                 done = self.root.checkdone()
                 if done:
                     break
                 relatives = this_family.get_family_branch_group()
-                gen = self.root.cookie.get(profile, "gen")
                 theparents = this_family.get_parents()
-                if complete:
-                    parentscount = len(theparents)
-                    rootprofile = this_family.get_focus()
-                if rootprofile:
-                    rootcount = self.root.cookie.get_parentmatch(profile, gen, rootprofile)
-                    if rootcount == 0:
-                        self.root.cookie.addParentCount(profile, gen, parentscount)
-                    else:
-                        self.root.cookie.addParentCount(profile, gen, parentscount*rootcount)
-                    for parent in theparents:
-                        self.root.cookie.add_parentmatch(profile, gen+1, parent)
-                    while rootcount > 1:
-                        rootcount -= 1
-                        for parent in theparents:
-                            self.root.cookie.add_parentmatch(profile, gen+1, parent)
 
                 for relative in relatives:
-                    if (project or problem) and relative.get_id() in options.historyprofiles:
-                        with self.lock:
-                            projects = self.root.base.backend.get_projects(relative.get_id(), project, problem)
-                            if len(projects) > 0:
-                                match = {"id": relative.get_id(), "relation": relative.get_rel(gen), "name": relative.get_name(), "message": False, "projects": projects}
-                                rematch = self.root.cookie.add_matches(profile, match)
+                    if (project or problem) and relative.get_id() in index:
+                        projects = index.get_projects(relative.get_id(), project, problem)
+                        if len(projects) > 0:
+                            match = {"id": relative.get_id(), "relation": relative.get_rel(gen), "name": relative.get_name(), "message": False, "projects": projects}
+                            rematch = self.root.cookie.add_matches(profile, match)
                     elif master and relative.is_master():
                         projects = [None]
                         match = {"id": relative.get_id(), "relation": relative.get_rel(gen), "name": relative.get_name(), "message": "Master Profile", "projects": projects}
@@ -800,30 +1168,87 @@ class SubWorker(threading.Thread):
                         match = {"id": relative.get_id(), "relation": relative.get_rel(gen), "name": relative.get_name(), "message": relative.get_message(), "projects": projects}
                         self.root.cookie.add_matches(profile, match)
                         rematch = True
-                count = int(self.root.cookie.get(profile, "count")) + len(relatives)
-                self.root.cookie.set(profile, "count", count)
-                history =  self.root.cookie.get_history(profile)
-                for parent in theparents:
-                    if not rematch and parent not in history:
-                        self.root.cookie.append_familyroot(profile, parent)
-                self.root.cookie.add_history(profile, self.root.cookie.get_familyroot(profile))
+                self.root.cookie.incr(profile, "count", len(relatives))
+                self.found.append((this_family.get_focus(), theparents, rematch))
+
+class Frontier(object):
+    """Profiles of one search still to be fetched, by generation.
+
+    A profile keeps the generation it was first reached at, as in a
+    generation by generation search: a generation is only handed out once
+    every generation two or more below it has finished, and a queued
+    profile reached again at a lower generation moves down. Generations
+    above limit are recorded in deepest but never queued; profiles only
+    reached there are kept apart from the visited set, so they can still
+    be queued if reached again within the limit. Each profile is added to
+    the visited set once.
+    """
+    def __init__(self, root, limit=None):
+        self.limit = limit
+        self.visited = profileset.IntSet([root])
+        self.beyond = profileset.IntSet()
+        self.pending = {0: profileset.IntSet([root])}
+        self.inflight = {}
+        self.closed = -1
+        self.deepest = 0
+
+    def __len__(self):
+        return sum(len(item) for item in self.pending.values())
+
+    def add(self, profile, gen):
+        if profile in self.visited:
+            for item in self.pending:
+                if item > gen and self.pending[item].discard(profile):
+                    self.pending.setdefault(gen, profileset.IntSet()).add(profile)
+                    break
+            return False
+        if gen > self.deepest:
+            self.deepest = gen
+        if self.limit is not None and gen > self.limit:
+            self.beyond.add(profile)
+            return False
+        self.beyond.discard(profile)
+        self.visited.add(profile)
+        self.pending.setdefault(gen, profileset.IntSet()).add(profile)
+        return True
+
+    def next_batch(self, size):
+        """Returns (gen, ids) for the next batch, or None if nothing can
+        be handed out yet."""
+        for gen in [item for item in self.pending if not self.pending[item]]:
+            del self.pending[gen]
+        if not self.pending:
+            return None
+        gen = min(self.pending)
+        ids = self.pending[gen]
+        for item in self.inflight:
+            if item <= gen - 2 and self.inflight[item]:
+                return None
+        # Wait for a full batch while the generation below can add to it.
+        if len(ids) < size and self.inflight.get(gen - 1):
+            return None
+        batch = [ids.pop() for i in range(min(size, len(ids)))]
+        self.inflight[gen] = self.inflight.get(gen, 0) + 1
+        return gen, batch
+
+    def finish(self, gen):
+        self.inflight[gen] -= 1
+
+    def close(self):
+        """Returns the generations that have now been searched completely,
+        lowest first."""
+        closed = []
+        while self.closed < self.deepest:
+            gen = self.closed + 1
+            if self.inflight.get(gen) or self.pending.get(gen):
+                break
+            self.pending.pop(gen, None)
+            self.closed = gen
+            closed.append(gen)
+        return closed
 
-            if complete:
-                for this_family in the_group:
-                    rootprofile = this_family.get_focus()
-                    if rootprofile:
-                        theparents = this_family.get_parents()
-                        parentscount = len(theparents)
-                        gen = self.root.cookie.get(profile, "gen")
-                        if not gen:
-                            return
-                        rootcount = self.root.cookie.get_parentmatch(profile, gen+1, rootprofile)
-                        if rootcount > 0:
-                            self.root.cookie.addParentCount(profile, gen+1, parentscount*rootcount)
-                            while rootcount > 0:
-                                rootcount -=1
-                                for parent in theparents:
-                                    self.root.cookie.add_parentmatch(profile, gen+2, parent)
+    def nbytes(self):
+        return self.visited.nbytes() + self.beyond.nbytes() + sum(item.nbytes() for item in self.pending.values())
 
 class LoginHandler(BaseHandler):
     @tornado.web.asynchronous
@@ -914,11 +1339,55 @@ class GeniCanvasHandler(HomeHandler):
         else:
             super(GeniCanvasHandler, self).get(*args, **kwds)
 
+class TimedConnection(object):
+    """Wraps a tornado.database.Connection to time every call."""
+    def __init__(self, db):
+        self.db = db
+
+    def _call(self, name, *args, **kwargs):
+        start = time.time()
+        try:
+            return getattr(self.db, name)(*args, **kwargs)
+        except:
+            _db_errors.inc(1, name)
+            raise
+        finally:
+            _db_seconds.observe(time.time() - start, name)
+
+    def query(self, *args, **kwargs):
+        return self._call("query", *args, **kwargs)
+
+    def get(self, *args, **kwargs):
+        return self._call("get", *args, **kwargs)
+
+    def execute(self, *args, **kwargs):
+        return self._call("execute", *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._call("executemany", *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
 class Backend(object):
+    # Held while options.historyprofiles is rebuilt or changed and swapped.
+    history_lock = threading.Lock()
+
     def __init__(self):
-        self.db = tornado.database.Connection(
-            host=options.mysql_host, database=options.mysql_database,
-            user=options.mysql_user, password=options.mysql_password)
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        """The calling thread's own connection. Handlers, search threads and
+        refresh workers all use the Backend at once; sharing one connection
+        would interleave their statements, and db.iter streams rows on an
+        unbuffered cursor that no other statement may cut into."""
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = self.local.db = TimedConnection(tornado.database.Connection(
+                host=options.mysql_host, database=options.mysql_database,
+                user=options.mysql_user, password=options.mysql_password))
+        return db
 
     @classmethod
     def instance(cls):
@@ -946,7 +1415,6 @@ class Backend(object):
         if not project_id.isdigit():
             return
         projectname = self.get_project_name(project_id, user)
-        self.delete_project(project_id)
         try:
             self.db.execute(
                 "INSERT INTO projects (id, name) VALUES (%s,%s) "
@@ -955,34 +1423,111 @@ class Backend(object):
             self.db.execute(
                 "INSERT INTO projects (id, name) VALUES (%s,%s) "
                 "ON DUPLICATE KEY UPDATE name=%s", project_id, projectname, projectname)
-        projectprofiles = self.get_project_profiles(project_id, user)
-        if projectprofiles and len(projectprofiles) > 0:
-            pass
-        else:
-            return
-        query = ""
-        for item in projectprofiles:
-            query += '(' + project_id + ',"' + str(item["id"]) + '"),'
-        query = "INSERT IGNORE INTO links (project_id,profile_id) VALUES " + query[:-1]
+        stored = self.get_project_links(project_id)
+        fresh = profileset.IntSet()
+        new = []
+
+        def added():
+            for item in self.iter_project_profiles(project_id, user, strict=True):
+                profile = str(item["id"])
+                if fresh.add(profile) and profile not in stored:
+                    new.append(profile)
+                    yield profile
+        complete = False
+        removed = []
         try:
-            self.db.execute(query)
+            try:
+                self.load_links(project_id, added())
+                complete = True
+            except Exception as e:
+                # A failed page, a dropped connection or a timeout: the rows
+                # read so far are in, the rest waits for the next refresh.
+                logging.warning("Paging project-%s failed, keeping its stored members: %s" % (project_id, e))
+            # Removals are only known once every page is in; an empty page
+            # run is more likely a failed fetch than an emptied project.
+            if complete and fresh:
+                removed = [profile for profile in stored if profile not in fresh]
+                self.delete_links(project_id, removed)
+            count = len(stored) + len(new) - len(removed)
+            logging.info("Refreshed project-%s: %d added, %d removed, %d members%s" % (
+                project_id, len(new), len(removed), count, "" if complete else " (incomplete)"))
+            # An incomplete refresh leaves refreshed alone so it is retried.
+            if complete:
+                query = "UPDATE projects SET count=%s, refreshed=UTC_TIMESTAMP() WHERE id=%s"
+            else:
+                query = "UPDATE projects SET count=%s WHERE id=%s"
+            try:
+                self.db.execute(query, count, project_id)
+            except:
+                self.db.execute(query, count, project_id)
+        finally:
+            # Whatever was inserted or deleted must reach the index and bump
+            # the links version, or the next refresh would treat the new rows
+            # as already indexed.
+            self.update_history_index(project_id, new, removed, projectname)
+        return complete
+
+    def get_project_links(self, project_id):
+        """Returns the profile ids stored for a project as an IntSet."""
+        try:
+            return profileset.IntSet(item["profile_id"] for item in
+                                     self.db.iter("SELECT profile_id FROM links WHERE project_id = %s", project_id))
         except:
-            self.db.execute(query)
+            return profileset.IntSet(item["profile_id"] for item in
+                                     self.db.iter("SELECT profile_id FROM links WHERE project_id = %s", project_id))
+
+    def delete_links(self, project_id, profiles):
+        """Deletes the links of profiles from a project,
+        options.link_chunk_size rows per statement."""
+        for start in range(0, len(profiles), options.link_chunk_size):
+            chunk = profiles[start:start + options.link_chunk_size]
+            query = "DELETE FROM links WHERE project_id = %s AND profile_id IN (" + ",".join(["%s"] * len(chunk)) + ")"
+            try:
+                self.db.execute(query, project_id, *chunk)
+            except:
+                self.db.execute(query, project_id, *chunk)
+
+    def load_links(self, project_id, profiles):
+        """Inserts a link row for each of the profile ids in profiles,
+        options.link_chunk_size rows per statement, while the profiles are
+        still being paged in. Each chunk commits on its own and is retried
+        once on failure. If profiles raises, the rows already read are
+        still inserted before the error is passed on."""
+        start = time.time()
+        rows = 0
+        chunk = []
+        try:
+            for profile in profiles:
+                chunk.append((project_id, profile))
+                if len(chunk) >= options.link_chunk_size:
+                    self.insert_links(chunk)
+                    rows += len(chunk)
+                    chunk = []
+        finally:
+            if chunk:
+                self.insert_links(chunk)
+                rows += len(chunk)
+        elapsed = time.time() - start
+        logging.info("Loaded %d links for project-%s in %.1fs (%.0f rows/s)" % (
+            rows, project_id, elapsed, rows / elapsed if elapsed else 0))
+        return rows
+
+    def insert_links(self, rows):
         try:
-            profilecount = self.db.query("SELECT COUNT(profile_id) FROM links WHERE project_id = %s", project_id)
+            self.db.executemany("INSERT IGNORE INTO links (project_id,profile_id) VALUES (%s,%s)", rows)
         except:
-            profilecount = self.db.query("SELECT COUNT(profile_id) FROM links WHERE project_id = %s", project_id)
-        if not profilecount:
-            return
-        if "COUNT(profile_id)" in profilecount[0]:
-            self.db.execute("UPDATE projects SET count=%s WHERE id=%s", int(profilecount[0]["COUNT(profile_id)"]), project_id)
-        return
+            self.db.executemany("INSERT IGNORE INTO links (project_id,profile_id) VALUES (%s,%s)", rows)
+        _links_loaded.inc(len(rows))
 
     def get_project_profiles(self, project, user):
         geni = self.get_API(user)
         project = geni.get_project_profiles(project)
         return project
 
+    def iter_project_profiles(self, project, user, strict=False):
+        geni = self.get_API(user)
+        return geni.iter_project_profiles(project, strict)
+
     def get_profile_name(self, profile, user):
         geni = self.get_API(user)
         return geni.get_profile_name(profile)
@@ -1007,6 +1552,13 @@ class Backend(object):
         giniapi = geni.GeniAPI(cookie)
         return giniapi
 
+    def get_async_API(self, user):
+        if user:
+            cookie = user['access_token']
+        else:
+            cookie = options.geni_app_id + "|" + options.geni_app_secret
+        return geni.AsyncGeniAPI(cookie)
+
     def query_projects(self):
         result = None
         try:
@@ -1018,24 +1570,96 @@ class Backend(object):
     def delete_project(self, id):
         if id:
             print "Deleting project-" + str(id)
+            removed = list(self.get_project_links(id))
             try:
                 self.db.execute("DELETE FROM links WHERE project_id=%s", id)
                 self.db.execute("DELETE FROM projects WHERE id=%s", id)
             except:
                 self.db.execute("DELETE FROM links WHERE project_id=%s", id)
                 self.db.execute("DELETE FROM projects WHERE id=%s", id)
+            self.update_history_index(id, (), removed, deleted=True)
         return
 
-    def get_history_profiles(self):
+    def build_history_index(self):
+        """Builds the index of profiles in projects, and the projects each
+        is in, from the links table. Saves it as the history_index
+        snapshot, if one is set. Called with history_lock held."""
+        logging.info("Building history profile index.")
+        # Read first: every links change is made before its version bump.
+        version = self.get_links_version()
+        try:
+            names = dict((item["id"], item["name"]) for item in self.db.query("SELECT id, name FROM projects"))
+            index = profileset.ProfileIndex.build(
+                ((item["profile_id"], item["project_id"]) for item in self.db.iter("SELECT profile_id, project_id FROM links")),
+                names, options.history_index_bloom, PROBLEM_PROJECT, version)
+        except:
+            names = dict((item["id"], item["name"]) for item in self.db.query("SELECT id, name FROM projects"))
+            index = profileset.ProfileIndex.build(
+                ((item["profile_id"], item["project_id"]) for item in self.db.iter("SELECT profile_id, project_id FROM links")),
+                names, options.history_index_bloom, PROBLEM_PROJECT, version)
+        index = profileset.LiveIndex(index)
+        if options.history_index:
+            index.save(options.history_index)
+        return index
+
+    def get_stale_projects(self, age=0):
+        """Returns the projects not refreshed for age seconds, never
+        refreshed first, then least recently refreshed, then largest."""
+        query = ("SELECT id, name, count, refreshed FROM projects "
+                 "WHERE refreshed IS NULL OR refreshed < UTC_TIMESTAMP() - INTERVAL %s SECOND "
+                 "ORDER BY refreshed IS NOT NULL, refreshed, count DESC")
+        try:
+            projects = self.db.query(query, age)
+        except:
+            projects = self.db.query(query, age)
+        return projects
+
+    def update_history_index(self, project_id, added, removed, name=None, deleted=False):
+        """Bumps the links version after one project's links changed, applies
+        the changes to the history index, swaps the result in and saves the
+        changes next to the snapshot."""
+        with self.history_lock:
+            version = self.bump_links_version()
+            index = options.historyprofiles
+            if index is None:
+                # Not built yet; the first search builds it from links.
+                return
+            index = index.apply(int(project_id), added, removed, name, deleted, version)
+            options.historyprofiles = index
+            if options.history_index:
+                try:
+                    index.save_changes(options.history_index)
+                except (IOError, OSError):
+                    logging.exception("Could not save history index changes")
+
+    def rebuild_history_index(self):
+        with self.history_lock:
+            options.historyprofiles = self.build_history_index()
+
+    def ensure_history_index(self):
+        """Builds the history index unless it is already there. The lock is
+        only taken when it is missing, so searches don't wait on a rebuild
+        of an index they can already use."""
+        if options.historyprofiles:
+            return
+        with self.history_lock:
+            if not options.historyprofiles:
+                options.historyprofiles = self.build_history_index()
+
+    def get_links_version(self):
+        try:
+            result = self.db.get("SELECT value FROM versions WHERE name='links'")
+        except:
+            result = self.db.get("SELECT value FROM versions WHERE name='links'")
+        return int(result["value"]) if result else 0
+
+    def bump_links_version(self):
+        query = "INSERT INTO versions (name, value) VALUES ('links', 1) ON DUPLICATE KEY UPDATE value=value+1"
         try:
-            profiles = self.db.query("SELECT DISTINCT profile_id FROM links")
+            self.db.execute(query)
         except:
-            profiles = self.db.query("SELECT DISTINCT profile_id FROM links")
-        logging.info("Building history profile list.")
-        profilelist = []
-        for item in profiles:
-            profilelist.append(item["profile_id"])
-        return profilelist
+            self.db.execute(query)
+        return self.get_links_version()
 
     def get_projectlist(self):
         try:
@@ -1044,21 +1668,6 @@ class Backend(object):
             projects = self.db.query("SELECT id,name FROM projects")
         return projects
 
-    def get_projects(self, id, project=None, problem=None):
-        try:
-            projects = self.db.query("SELECT links.project_id, projects.name FROM links, projects WHERE links.project_id=projects.id AND links.profile_id = %s", id)
-        except:
-            projects = self.db.query("SELECT links.project_id, projects.name FROM links, projects WHERE links.project_id=projects.id AND links.profile_id = %s", id)
-        projectlist = []
-        for item in projects:
-            if problem and project:
-                projectlist.append({"id": item["project_id"], "name": item["name"]})
-            elif problem and item["project_id"] == 10985:
-                projectlist.append({"id": item["project_id"], "name": item["name"]})
-            elif project and item["project_id"] != 10985:
-                projectlist.append({"id": item["project_id"], "name": item["name"]})
-        return projectlist
-
     def get_profile_count(self):
         profilecount = None
         count = 0
@@ -1118,6 +1727,32 @@ def main():
     else:
         path = os.path.join(os.path.dirname(__file__), "settings.py")
         tornado.options.parse_config_file(path)
+    geni.GeniAPI.pool.maxsize = options.geni_pool_size
+    geni.GeniAPI.limiter = geni.RateLimiter(options.geni_rate, options.geni_burst)
+    geni.GeniAPI.denied.ttl = options.geni_denied_ttl
+    geni.GeniAPI.families = geni.ExpiringCache(options.geni_family_cache_size, options.geni_family_ttl)
+    geni.GeniAPI.project_prefetch = options.project_prefetch
+    HistoryWorker.pool = WorkerPool(options.worker_threads)
+    if options.history_index and os.path.exists(options.history_index):
+        try:
+            index = profileset.LiveIndex.load(options.history_index)
+            version = Backend.instance().get_links_version()
+            if index.version != version:
+                logging.info("%s is at links version %d, not %d; not using it",
+                             options.history_index, index.version, version)
+            else:
+                options.historyprofiles = index
+                logging.info("Loaded %d history profiles from %s", len(index), options.history_index)
+        except Exception:
+            logging.exception("Could not load " + options.history_index)
+    LinkHolder.cookie.maxsize = options.max_sessions
+    LinkHolder.cookie.ttl = options.session_ttl
+    if options.family_store:
+        geni.GeniAPI.store = geni.FamilyStore(options.family_store, options.family_store_max_age)
+    ProjectScheduler._instance = ProjectScheduler(options.refresh_threads, options.refresh_interval,
+                                                  options.refresh_period)
+    if options.refresh_interval:
+        ProjectScheduler.instance().start()
     from tornado.httpserver import HTTPServer
     from tornado.ioloop import IOLoop
     #from tornado.wsgi import WSGIContainer 
@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2013 Jeff Gentes
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+#Compact sets of Geni profile ids. "profile-NNN" ids are kept as machine
+#integers in a sorted array, so a search's visited set costs about eight
+#bytes per profile instead of a string and a set slot. ProfileIndex is the
+#read-only index of the profiles in projects and the projects each is in,
+#saved to a snapshot file that is memory-mapped at startup.
+
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+from array import array
+
+PREFIX = "profile-"
+_TYPECODE = "L"
+_MAX = 2 ** (8 * array(_TYPECODE).itemsize) - 1
+
+
+def encode(profile):
+    """Returns the number of a "profile-NNN" id, or None for any other id."""
+    if isinstance(profile, basestring) and profile.startswith(PREFIX):
+        number = profile[len(PREFIX):]
+        if number.isdigit() and int(number) <= _MAX:
+            return int(number)
+    return None
+
+
+def decode(number):
+    return PREFIX + str(number)
+
+
+class IntSet(object):
+    """Set of profile ids.
+
+    Numeric ids live in a sorted array plus a small unsorted buffer that is
+    merged into it once it grows past an eighth of the array. Other ids go
+    in a plain set. Not thread safe.
+    """
+    def __init__(self, profiles=()):
+        self.sorted = array(_TYPECODE)
+        self.buffer = set()
+        self.other = set()
+        for profile in profiles:
+            self.add(profile)
+
+    def __len__(self):
+        return len(self.sorted) + len(self.buffer) + len(self.other)
+
+    def __contains__(self, profile):
+        number = encode(profile)
+        if number is None:
+            return profile in self.other
+        return number in self.buffer or self._find(number) >= 0
+
+    def __iter__(self):
+        for number in self.sorted:
+            yield decode(number)
+        for number in self.buffer:
+            yield decode(number)
+        for profile in self.other:
+            yield profile
+
+    def _find(self, number):
+        index = bisect.bisect_left(self.sorted, number)
+        if index < len(self.sorted) and self.sorted[index] == number:
+            return index
+        return -1
+
+    def add(self, profile):
+        """Adds profile; returns False if it was already in the set."""
+        number = encode(profile)
+        if number is None:
+            if profile in self.other:
+                return False
+            self.other.add(profile)
+            return True
+        if number in self.buffer or self._find(number) >= 0:
+            return False
+        self.buffer.add(number)
+        if len(self.buffer) > max(256, len(self.sorted) // 8):
+            self.merge()
+        return True
+
+    def discard(self, profile):
+        """Removes profile; returns False if it was not in the set."""
+        number = encode(profile)
+        if number is None:
+            if profile not in self.other:
+                return False
+            self.other.discard(profile)
+            return True
+        if number in self.buffer:
+            self.buffer.discard(number)
+            return True
+        index = self._find(number)
+        if index < 0:
+            return False
+        del self.sorted[index]
+        return True
+
+    def pop(self):
+        if self.buffer:
+            return decode(self.buffer.pop())
+        if self.sorted:
+            return decode(self.sorted.pop())
+        return self.other.pop()
+
+    def merge(self):
+        if self.buffer:
+            self.sorted = array(_TYPECODE, sorted(self.sorted.tolist() + list(self.buffer)))
+            self.buffer = set()
+
+    def nbytes(self):
+        """Approximate memory held by the numeric ids, in bytes."""
+        return len(self.sorted) * self.sorted.itemsize + len(self.buffer) * 32
+
+
+_MAGIC = "HLPI0002"
+_HEADER = struct.Struct("<8sQQQQQQ")
+_ID = struct.Struct("<Q")
+_OFFSET = struct.Struct("<I")
+_CHUNK = 65536
+_FENCE = 256
+
+# Bits of a profile's flag byte: in the problem project, in any other.
+PROBLEM = 1
+PROJECT = 2
+
+
+class ProfileIndex(object):
+    """Read-only index of the profiles in projects: the sorted profile ids,
+    searched by bisection, and for each the projects it is in.
+
+    The ids can sit in a string or in a memory-mapped snapshot file, so
+    loading a snapshot costs no time or private memory whatever its size.
+    An optional Bloom filter in front answers most misses without touching
+    the id array. Each profile also has a flag byte saying whether it is in
+    the problem project, in another project or both, so most project
+    lookups stop there. Ids that are not "profile-NNN" are kept in a dict.
+
+    Snapshot layout: header (magic, id count, link count, Bloom bits, Bloom
+    hashes, problem project, metadata length), the ids, the offsets of each
+    id's projects, the project ids, the flags, the Bloom filter, then the
+    other ids, project names and links version as JSON.
+    """
+    def __init__(self, data, close=None):
+        (magic, self.count, self.links, self.bloom_bits, self.bloom_hashes,
+         self.problem, meta) = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError("Not a profile index")
+        self.data = data
+        self.close = close
+        self.ids = _HEADER.size
+        self.offsets = self.ids + self.count * _ID.size
+        self.postings = self.offsets + (self.count + 1) * _OFFSET.size
+        self.flags = self.postings + self.links * _OFFSET.size
+        self.bloom = self.flags + self.count
+        # Every _FENCE-th id, so find bisects in C down to a short run.
+        self.fences = array(_TYPECODE, (self.number(index) for index in xrange(0, self.count, _FENCE)))
+        start = self.bloom + self.bloom_bits // 8
+        meta = json.loads(data[start:start + meta])
+        self.other = meta["other"]
+        self.names = dict((int(key), value) for key, value in meta["names"].items())
+        self.version = meta.get("version", 0)
+
+    @classmethod
+    def build(cls, links, names=None, bloom_bits=10, problem=None, version=0):
+        """Builds an index from (profile id, project id) pairs.
+
+        names maps project id to name; only projects in it are returned by
+        get_projects, though every link is kept. bloom_bits is the number of
+        Bloom filter bits per id, 0 for none. version is the links version
+        the pairs were read at.
+        """
+        numbers = array(_TYPECODE)
+        projects = array(_TYPECODE)
+        other = {}
+        for profile, project in links:
+            project = int(project)
+            number = encode(profile)
+            if number is None:
+                other.setdefault(profile, set()).add(project)
+            else:
+                numbers.append(number)
+                projects.append(project)
+        order = sorted(xrange(len(numbers)), key=numbers.__getitem__)
+        distinct = []
+        postings = []
+        for index in order:
+            if not distinct or distinct[-1] != numbers[index]:
+                distinct.append(numbers[index])
+                postings.append(set())
+            postings[-1].add(projects[index])
+        del numbers, projects, order
+        other = dict((key, sorted(value)) for key, value in other.items())
+        if names is None:
+            names = dict((item, None) for projects in postings + other.values() for item in projects)
+        return cls(cls.pack(distinct, postings, other, names, bloom_bits, problem, version))
+
+    @classmethod
+    def pack(cls, numbers, postings, other=None, names=None, bloom_bits=10, problem=None, version=0):
+        """Returns the snapshot bytes for sorted, distinct numbers and the
+        project ids of each."""
+        bits = 0
+        hashes = 0
+        if bloom_bits and numbers:
+            bits = (len(numbers) * bloom_bits + 7) // 8 * 8
+            hashes = max(1, int(round(bloom_bits * 0.693)))
+        meta = json.dumps({"other": other or {}, "names": names or {}, "version": version})
+        links = sum(len(item) for item in postings)
+        parts = [_HEADER.pack(_MAGIC, len(numbers), links, bits, hashes, problem or 0, len(meta))]
+        for start in range(0, len(numbers), _CHUNK):
+            chunk = numbers[start:start + _CHUNK]
+            parts.append(struct.pack("<%dQ" % len(chunk), *chunk))
+        offsets = array(_TYPECODE, [0])
+        flags = bytearray(len(numbers))
+        for index, projects in enumerate(postings):
+            offsets.append(offsets[-1] + len(projects))
+            for project in projects:
+                if names is None or project in names:
+                    flags[index] |= PROBLEM if problem and project == problem else PROJECT
+        for start in range(0, len(offsets), _CHUNK):
+            chunk = offsets[start:start + _CHUNK]
+            parts.append(struct.pack("<%dI" % len(chunk), *chunk))
+        chunk = []
+        for projects in postings:
+            chunk.extend(sorted(projects))
+            if len(chunk) >= _CHUNK:
+                parts.append(struct.pack("<%dI" % len(chunk), *chunk))
+                chunk = []
+        parts.append(struct.pack("<%dI" % len(chunk), *chunk))
+        parts.append(str(flags))
+        if bits:
+            bloom = bytearray(bits // 8)
+            for number in numbers:
+                for position in _positions(number, bits, hashes):
+                    bloom[position >> 3] |= 1 << (position & 7)
+            parts.append(str(bloom))
+        parts.append(meta)
+        return "".join(parts)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps the snapshot at path."""
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(data, data.close)
+        except Exception:
+            data.close()
+            raise
+
+    def save(self, path):
+        """Writes the snapshot to path, replacing any old one atomically."""
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(self.data[:])
+        os.rename(temp, path)
+        logging.info("Saved %d history profiles to %s", len(self), path)
+
+    def __len__(self):
+        return self.count + len(self.other)
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __contains__(self, profile):
+        return self.position(profile) is not None
+
+    def position(self, profile):
+        """Returns the position of a "profile-NNN" id in the index, -1 for
+        an other id in it, or None if the profile is not in it."""
+        number = encode(profile)
+        if number is None:
+            return -1 if profile in self.other else None
+        bits = self.bloom_bits
+        if bits:
+            data = self.data
+            bloom = self.bloom
+            value = (number * _GOLDEN) & 0xFFFFFFFFFFFFFFFF
+            position = value & 0xFFFFFFFF
+            step = (value >> 32) | 1
+            for i in xrange(self.bloom_hashes):
+                bit = position % bits
+                if not ord(data[bloom + (bit >> 3)]) & (1 << (bit & 7)):
+                    return None
+                position += step
+        index = self.find(number)
+        if index < self.count and self.number(index) == number:
+            return index
+        return None
+
+    def __iter__(self):
+        for index in xrange(self.count):
+            yield decode(self.number(index))
+        for profile in self.other:
+            yield profile
+
+    def number(self, index):
+        return _ID.unpack_from(self.data, self.ids + index * _ID.size)[0]
+
+    def find(self, number):
+        """Returns the position of the first id >= number."""
+        fence = bisect.bisect_right(self.fences, number) - 1
+        if fence < 0:
+            return 0
+        low, high = fence * _FENCE, min((fence + 1) * _FENCE, self.count)
+        while low < high:
+            middle = (low + high) // 2
+            if self.number(middle) < number:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def numbers(self):
+        return [self.number(index) for index in xrange(self.count)]
+
+    def project_ids(self, index):
+        """Returns the project ids of the profile at position index."""
+        start, end = struct.unpack_from("<2I", self.data, self.offsets + index * _OFFSET.size)
+        return struct.unpack_from("<%dI" % (end - start), self.data, self.postings + start * _OFFSET.size)
+
+    def profile_projects(self, profile):
+        """Returns the ids of all projects profile is in."""
+        index = self.position(profile)
+        if index is None:
+            return ()
+        if index < 0:
+            return self.other[profile]
+        return self.project_ids(index)
+
+    def get_projects(self, profile, project=None, problem=None, names=None):
+        """Returns the projects of profile as {"id", "name"} dicts: all of
+        them if project and problem are both set, only the problem project
+        for problem and only the others for project. Projects missing from
+        names, by default the names the index was built with, are left
+        out."""
+        index = self.position(profile)
+        if index is None:
+            return []
+        if index < 0:
+            projects = self.other[profile]
+        else:
+            wanted = (PROBLEM if problem else 0) | (PROJECT if project else 0)
+            if not ord(self.data[self.flags + index]) & wanted:
+                return []
+            projects = self.project_ids(index)
+        return filter_projects(projects, names if names is not None else self.names,
+                               self.problem, project, problem)
+
+    def nbytes(self):
+        return len(self.data)
+
+
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def _positions(number, bits, hashes):
+    value = (number * _GOLDEN) & 0xFFFFFFFFFFFFFFFF
+    first = value & 0xFFFFFFFF
+    step = (value >> 32) | 1
+    for i in xrange(hashes):
+        yield (first + i * step) % bits
+
+
+def filter_projects(projects, names, problem_project, project=None, problem=None):
+    projectlist = []
+    for item in projects:
+        if item not in names:
+            continue
+        if problem and project:
+            projectlist.append({"id": item, "name": names[item]})
+        elif problem and item == problem_project:
+            projectlist.append({"id": item, "name": names[item]})
+        elif project and item != problem_project:
+            projectlist.append({"id": item, "name": names[item]})
+    return projectlist
+
+
+class LiveIndex(object):
+    """A ProfileIndex together with the project changes made since it was
+    built.
+
+    changes holds the current projects of every profile a change touched;
+    the number of them is the profile's reference count, and it stays in
+    the index while that is above zero. A LiveIndex is never modified:
+    apply returns a new one, so it can be swapped in with one assignment
+    while searches keep reading the old one.
+
+    version is the links version the index reflects. save_changes writes
+    the changes next to the base snapshot, and load reads both back.
+    """
+    def __init__(self, base, changes=None, names=None, size=None, version=None):
+        self.base = base
+        self.changes = changes or {}
+        self.names = names if names is not None else base.names
+        if size is None:
+            size = len(base)
+            for profile, projects in self.changes.items():
+                size += bool(projects) - (profile in base)
+        self.size = size
+        self.version = version if version is not None else base.version
+
+    @classmethod
+    def load(cls, path):
+        """Memory-maps the snapshot at path and applies the changes saved
+        with it, if they were made on top of that snapshot."""
+        base = ProfileIndex.load(path)
+        try:
+            with open(path + ".changes", "rb") as f:
+                saved = json.load(f)
+        except IOError:
+            return cls(base)
+        if saved["base"] != base.version:
+            return cls(base)
+        changes = dict((profile, frozenset(projects)) for profile, projects in saved["changes"].items())
+        names = dict((int(key), value) for key, value in saved["names"].items())
+        return cls(base, changes, names, version=saved["version"])
+
+    def __len__(self):
+        return self.size
+
+    def __nonzero__(self):
+        return self.size > 0
+
+    def __contains__(self, profile):
+        projects = self.changes.get(profile)
+        if projects is not None:
+            return bool(projects)
+        return profile in self.base
+
+    def projects_of(self, profile):
+        projects = self.changes.get(profile)
+        if projects is not None:
+            return projects
+        return frozenset(self.base.profile_projects(profile))
+
+    def get_projects(self, profile, project=None, problem=None):
+        projects = self.changes.get(profile)
+        if projects is None:
+            return self.base.get_projects(profile, project, problem, self.names)
+        return filter_projects(sorted(projects), self.names, self.base.problem, project, problem)
+
+    def apply(self, project, added=(), removed=(), name=None, deleted=False, version=None):
+        """Returns a new LiveIndex at version with added profiles linked to
+        project and removed ones unlinked. name, if given, becomes the
+        project's name; deleted drops the project from the names."""
+        changes = dict(self.changes)
+        size = self.size
+        for profile in added:
+            projects = changes.get(profile)
+            if projects is None:
+                projects = self.projects_of(profile)
+            if project not in projects:
+                if not projects:
+                    size += 1
+                changes[profile] = projects | frozenset([project])
+        for profile in removed:
+            projects = changes.get(profile)
+            if projects is None:
+                projects = self.projects_of(profile)
+            if project in projects:
+                changes[profile] = projects - frozenset([project])
+                if not changes[profile]:
+                    size -= 1
+        names = self.names
+        if deleted or (name is not None and names.get(project) != name):
+            names = dict(names)
+            if deleted:
+                names.pop(project, None)
+            else:
+                names[project] = name
+        return LiveIndex(self.base, changes, names, size,
+                         version if version is not None else self.version)
+
+    def stale(self):
+        """True once the changes are large enough that the index should be
+        rebuilt."""
+        return len(self.changes) > max(10000, self.base.count // 20)
+
+    def save(self, path):
+        """Writes the base snapshot and then the changes on top of it."""
+        self.base.save(path)
+        self.save_changes(path)
+
+    def save_changes(self, path):
+        """Writes the changes next to the snapshot at path, replacing the
+        old ones atomically."""
+        temp = path + ".changes.tmp"
+        with open(temp, "wb") as f:
+            json.dump({"base": self.base.version, "version": self.version,
+                       "changes": dict((profile, sorted(projects)) for profile, projects in self.changes.items()),
+                       "names": self.names}, f)
+        os.rename(temp, path + ".changes")
+
+    def nbytes(self):
+        return self.base.nbytes() + len(self.changes) * 200
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Copyright 2012-2013 Jeff Gentes
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+#Relation labels such as "5th great grandfather", shared by geni.py and
+#historylink.py. Labels are built once per (relation, generation).
+
+# A relative of an ancestor, as seen from the searched profile.
+_ANCESTOR_RELATIONS = {
+    "sister": "aunt",
+    "brother": "uncle",
+    "sibling": "aunt/uncle",
+    "father": "grandfather",
+    "mother": "grandmother",
+    "wife": "spouse",
+    "husband": "spouse",
+    "spouse": "spouse",
+    }
+
+_labels = {}
+_generations = {}
+
+
+def ordinal(number):
+    """1 -> "1st", 2 -> "2nd", 11 -> "11th", 22 -> "22nd"."""
+    if 10 <= number % 100 <= 20:
+        return str(number) + "th"
+    return str(number) + {1: "st", 2: "nd", 3: "rd"}.get(number % 10, "th")
+
+
+def great_prefix(greats):
+    """0 -> "", 1 -> "great ", 2 -> "2nd great ", 3 -> "3rd great "."""
+    if greats < 1:
+        return ""
+    if greats == 1:
+        return "great "
+    return ordinal(greats) + " great "
+
+
+def relation_label(relation, gen=0):
+    """Relation of a relative found in the family of a gen'th generation
+    ancestor, e.g. ("brother", 2) -> "great uncle"."""
+    key = (relation, gen)
+    label = _labels.get(key)
+    if label is None:
+        if gen == 0:
+            label = relation
+        else:
+            #todo likely needs some work on half siblings, step parents, gen 1, etc.
+            label = great_prefix(gen - 1) + _ANCESTOR_RELATIONS.get(relation, "aunt/uncle/grandparent")
+        _labels[key] = label
+    return label
+
+
+def generation_label(gen):
+    """Name of the ancestors searched in generation gen: -1 -> "profile",
+    0 -> "parent", 1 -> "grand parent", 3 -> "2nd great grandparent"."""
+    label = _generations.get(gen)
+    if label is None:
+        if gen < 0:
+            label = "profile"
+        elif gen == 0:
+            label = "parent"
+        elif gen == 1:
+            label = "grand parent"
+        else:
+            label = great_prefix(gen - 1) + "grandparent"
+        _generations[gen] = label
+    return label
+
+
+def generation_prefix(gen):
+    """Ordinal in front of "great grandparent" for generation gen."""
+    if gen - 1 < 2:
+        return ""
+    return ordinal(gen - 1)
@@ -14,4 +14,8 @@ geni_canvas_id = "http://www.geni.com/platform/apps/historylink/"
 geni_namespace = "historylink"
 
 app_url = "localhost:8080"
+
+family_store = "families.db"
+history_index = "history.idx"
+metrics_token = "*********"
 debug = True
\ No newline at end of file